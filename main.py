@@ -7,6 +7,7 @@ import re, os.path
 from css_parser import  css, stylesheets
 from html.parser import HTMLParser
 from html.entities import name2codepoint
+from lxml import etree
 
 try:
     from qt.core import (Qt, QAction, QDialog, QApplication, QCursor)
@@ -14,6 +15,7 @@ except ImportError:
     from PyQt5.Qt import (Qt, QAction, QDialog, QApplication, QCursor)
 
 
+from calibre.constants import cache_dir
 from calibre.gui2.tweak_book.plugin import Tool
 from calibre.gui2.tweak_book import editor_name
 from calibre.gui2 import error_dialog, info_dialog
@@ -25,6 +27,7 @@ except:
 
 from calibre_plugins.chinese_text.__init__ import (PLUGIN_NAME, PLUGIN_SAFE_NAME)
 from calibre_plugins.chinese_text.resources.opencc_python.opencc import OpenCC
+from calibre_plugins.chinese_text.resources.opencc_python.preload import PreloadedResources
 
 '''
 TradSimpChinese
@@ -46,6 +49,14 @@ https://en.wikipedia.org/wiki/Debate_on_traditional_and_simplified_Chinese_chara
 
 CONFIG_FILE = 'config'
 DICT_FILE = 'dictionary'
+COMPILED_FILE = 'compiled'
+
+# Number of converted text segments remembered by the converter. Books repeat
+# names, dialogue tags and headings often.
+SEGMENT_CACHE_SIZE = 4096
+
+# Directory where the converter keeps compiled dictionaries between runs
+COMPILED_CACHE_DIR = os.path.join(cache_dir(), PLUGIN_SAFE_NAME)
 
 
 # Default punctuation characters that are not enabled. Used to set the values for default button in
@@ -88,26 +99,37 @@ def get_resource_file(file_type, file_name):
         return get_resources('resources/opencc_python/config/' + file_name)
     elif file_type == DICT_FILE:
         return get_resources('resources/opencc_python/dictionary/' + file_name)
+    elif file_type == COMPILED_FILE:
+        # Built by resources/opencc_python/dictionary/reverse.py, None if not built
+        return get_resources('resources/opencc_python/compiled/' + file_name)
     else:
         raise ValueError('conversion value incorrect')
 
 
+# Calibre function reading several resource files with one pass over the plugin zip
+def get_resource_files(names):
+    return get_resources(names, print_tracebacks_for_missing_resources=False)
+
+
+# Resource getter passed into converters. Each conversion reads its config file,
+# then all its dictionaries and its compiled conversion, with one zip pass each.
+resource_getter = PreloadedResources(get_resource_files, {
+    CONFIG_FILE: 'resources/opencc_python/config/',
+    DICT_FILE: 'resources/opencc_python/dictionary/',
+    COMPILED_FILE: 'resources/opencc_python/compiled/'})
+
+
 # regular expression to remove ruby text
 # newstring = oldstring.replace(/<rb>([^<]*)<\/rb>|<rp>[^<]*<\/rp>|<rt>[^<]*<\/rt>|<\/?ruby>/g, "$1");
 
-class HTML_TextProcessor(HTMLParser):
+class TextStyleProcessor:
     """
-    This class takes in HTML files as a string.
+    This class updates the quotation marks and punctuation of text as selected
+    in self.criteria, for the HTML and lxml text processors.
     """
 
-    def __init__(self, textConvertor = None):
-          super().__init__(convert_charrefs=False)
-          self.recording = 0
-          self.result = []
-          self.textConverter = textConvertor
+    def __init__(self):
           self.criteria = None
-          self.converting = True
-          self.language = None
 
           # Create regular expressions to modify quote styles
           self.trad_to_simp_quotes = {'「':'“', '」':'”', '『':'‘', '』':'’'}
@@ -116,20 +138,6 @@ class HTML_TextProcessor(HTMLParser):
           self.simp_to_trad_quotes = {'“':'「', '”':'」', '‘':'『', '’':'』'}
           self.simp_to_trad_re = re.compile('|'.join(map(re.escape, self.simp_to_trad_quotes)))
 
-          # Create regular expression to look for common transliterated Chinese lang attributes
-          self.zh_non_re = re.compile(r'lang=\"zh-Latn|lang=\"zh-Cyrl|lang=\"zh-Bopo|lang=\"zh-Mong', re.IGNORECASE)
-
-          # Create regular expression to modify lang attribute
-          self.zh_re = re.compile(r'lang=\"zh-[\-\w+]+\"|lang=\"zh\"', re.IGNORECASE)
-
-
-    # Use this if one wants to reset the converter
-    def setTextConvertor(self, textConvertor):
-        self.textConverter = textConvertor
-
-    def setLanguageAttribute(self, language):
-        self.language = language
-
     def replace_quotations(self, data):
         # update quotes if desired
         if self.criteria[QUOTATION_TYPE] == 1:
@@ -144,6 +152,24 @@ class HTML_TextProcessor(HTMLParser):
         return htmlstr_corrected
 
 
+    # Update quotation marks and punctuation as selected in self.criteria
+    def replace_punctuation(self, text):
+        if (self.criteria[OUTPUT_ORIENTATION] == 0) or (self.criteria[OUTPUT_ORIENTATION] == 2):
+            # Convert quotation marks
+            if (self.criteria[QUOTATION_TYPE] != 0):
+                text = self.replace_quotations(text)
+
+        # Convert punctuation to vertical or horizontal using provided regular expression
+        # self.criteria[PUNC_REGEX] is only set if vertical or horizontal change selected
+        if self.criteria[PUNC_REGEX] != None:
+            text = self.multiple_replace(self.criteria[PUNC_REGEX], self.criteria[PUNC_DICT], text)
+
+        if (self.criteria[OUTPUT_ORIENTATION] == 1):
+            # Convert quotation marks
+            if (self.criteria[QUOTATION_TYPE] != 0):
+                text = self.replace_quotations(text)
+        return text
+
     # multiple_replace copied from ActiveState http://code.activestate.com/recipes/81330-single-pass-multiple-replace/
     # Copyright 2001 Xavier Defrang
     # PSF (Python Software Foundation) license (GPL Compatible)
@@ -152,12 +178,44 @@ class HTML_TextProcessor(HTMLParser):
       # For each match, look-up corresponding value in dictionary
       return replace_regex.sub(lambda mo: replace_dict[mo.string[mo.start():mo.end()]], text)
 
+
+class HTML_TextProcessor(HTMLParser, TextStyleProcessor):
+    """
+    This class takes in HTML files as a string.
+    """
+
+    def __init__(self, textConvertor = None):
+          super().__init__(convert_charrefs=False)
+          TextStyleProcessor.__init__(self)
+          self.recording = 0
+          self.result = []
+          # Indexes into self.result of the text to be converted
+          self.pending = []
+          self.textConverter = textConvertor
+          self.converting = True
+          self.language = None
+
+          # Create regular expression to look for common transliterated Chinese lang attributes
+          self.zh_non_re = re.compile(r'lang=\"zh-Latn|lang=\"zh-Cyrl|lang=\"zh-Bopo|lang=\"zh-Mong', re.IGNORECASE)
+
+          # Create regular expression to modify lang attribute
+          self.zh_re = re.compile(r'lang=\"zh-[\-\w+]+\"|lang=\"zh\"', re.IGNORECASE)
+
+
+    # Use this if one wants to reset the converter
+    def setTextConvertor(self, textConvertor):
+        self.textConverter = textConvertor
+
+    def setLanguageAttribute(self, language):
+        self.language = language
+
     def processText(self, data, criteria):
 ##        print("processText:", data)
 ##        print('processText Criteria: ', criteria)
 
         self.criteria = criteria
         self.result.clear()
+        self.pending.clear()
         self.reset()
         if self.criteria[INPUT_SOURCE] == 2:
             # turn off converting until a start comment seen
@@ -168,9 +226,24 @@ class HTML_TextProcessor(HTMLParser):
 ##        print("Feeding in text")
         self.feed(data)
         self.close()
+        # Convert all the text of the file in one batch
+        if len(self.pending) > 0:
+            converted = self.textConverter.convert_many([self.result[i] for i in self.pending])
+            for i, text in zip(self.pending, converted):
+                self.result[i] = text
         # return result
         return "".join(self.result)
 
+    def processFile(self, container, name, criteria):
+        # Convert the file name of the container, returns True if it changed
+        data = container.raw_data(name)
+        htmlstr = self.processText(data, criteria)
+        if htmlstr == data:
+            return False
+        container.open(name, 'w').write(htmlstr)
+        container.dirty(name)
+        return True
+
     def handle_starttag(self, tag, attrs):
         ##print("Literal start tag:", self.get_starttag_text())
         ##print("Start tag:", tag)
@@ -220,26 +293,14 @@ class HTML_TextProcessor(HTMLParser):
             self.result.append(text)
         else:
             if self.converting:
-                if (self.criteria[OUTPUT_ORIENTATION] == 0) or (self.criteria[OUTPUT_ORIENTATION] == 2):
-                    # Convert quotation marks
-                    if (self.criteria[QUOTATION_TYPE] != 0):
-                        text = self.replace_quotations(text)
-
-                # Convert punctuation to vertical or horizontal using provided regular expression
-                # self.criteria[PUNC_REGEX] is only set if vertical or horizontal change selected
-                if self.criteria[PUNC_REGEX] != None:
-                    text = self.multiple_replace(self.criteria[PUNC_REGEX], self.criteria[PUNC_DICT], text)
-
-                if (self.criteria[OUTPUT_ORIENTATION] == 1):
-                    # Convert quotation marks
-                    if (self.criteria[QUOTATION_TYPE] != 0):
-                        text = self.replace_quotations(text)
+                text = self.replace_punctuation(text)
 
             # Convert text to traditional or simplified if needed
 ##            print('handle_data CONVERSION_TYPE criteria = ', self.criteria[CONVERSION_TYPE])
             if self.criteria[CONVERSION_TYPE] != 0 and self.converting:
-##                print('handle_data calling self.textConverter.convert(text)')
-                self.result.append(self.textConverter.convert(text))
+##                print('handle_data queueing text for self.textConverter.convert_many()')
+                self.pending.append(len(self.result))
+                self.result.append(text)
             else:
 ##                print('handle_data NOT calling self.textConverter.convert(text)')
                 self.result.append(text)
@@ -286,10 +347,150 @@ class HTML_TextProcessor(HTMLParser):
 ##        print("Unknown Decl     :", data)
 
 
+class LXML_TextProcessor(TextStyleProcessor):
+    """
+    This class converts the lxml tree of HTML files parsed by the container.
+    Text and tail nodes are converted in place, so only files where a node
+    changed are marked dirty and serialized again. The criteria are applied
+    the same way as by HTML_TextProcessor, but changed files are written by
+    lxml, so their markup can differ from the raw HTML HTML_TextProcessor
+    keeps (e.g. entities are written as characters). It is only used when
+    asked for (--lxml on the command line).
+    """
+
+    # Attributes holding the language of an element
+    LANG_ATTRIBUTES = ('lang', '{http://www.w3.org/XML/1998/namespace}lang')
+
+    # HTML elements that never have content, always written as self-closing tags
+    VOID_ELEMENTS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+                               'param', 'source', 'track', 'wbr'))
+
+    # Namespaces of HTML elements, other elements (SVG, MathML) without content are self-closing
+    HTML_NAMESPACES = ('', 'http://www.w3.org/1999/xhtml')
+
+    def __init__(self, textConvertor = None):
+          super().__init__()
+          self.textConverter = textConvertor
+          self.converting = True
+          # Language code set in lang attributes, e.g. zh-Hant
+          self.language_code = None
+          # Nodes and whether it is their tail, of the text to be converted
+          self.nodes = []
+          # Text of self.nodes, in the same order
+          self.texts = []
+
+          # Create regular expressions to match Chinese lang attribute values
+          self.zh_value_re = re.compile(r'zh-[\-\w+]+|zh', re.IGNORECASE)
+          self.zh_non_value_re = re.compile(r'zh-Latn|zh-Cyrl|zh-Bopo|zh-Mong', re.IGNORECASE)
+
+    # Use this if one wants to reset the converter
+    def setTextConvertor(self, textConvertor):
+        self.textConverter = textConvertor
+
+    def setLanguageCode(self, language_code):
+        # language_code is set in lang attributes, e.g. zh-Hant. None to keep them.
+        self.language_code = language_code
+
+    def processFile(self, container, name, criteria):
+        # Convert the file name of the container, returns True if it changed
+        if self.processTree(container.parsed(name), criteria):
+            container.dirty(name)
+            return True
+        return False
+
+    def processTree(self, root, criteria):
+        # Convert the tree in place, returns True if a node changed
+        self.criteria = criteria
+        # Only convert after a start comment when converting selected text
+        self.converting = self.criteria[INPUT_SOURCE] != 2
+        changed = False
+        self.nodes.clear()
+        self.texts.clear()
+
+        for event, node in etree.iterwalk(root, events=('start', 'end', 'comment', 'pi')):
+            if event == 'start':
+                changed = self.processElement(node) or changed
+                changed = self.processNodeText(node, False) or changed
+            else:
+                if event == 'comment' and self.criteria[INPUT_SOURCE] == 2:
+                    if node.text.strip() == seltext_start_tag:
+                        self.converting = True
+                    elif node.text.strip() == seltext_end_tag:
+                        self.converting = False
+                changed = self.processNodeText(node, True) or changed
+
+        # Convert all the text of the file in one batch
+        if len(self.nodes) > 0:
+            converted = self.textConverter.convert_many(self.texts)
+            for (node, is_tail), text, original in zip(self.nodes, converted, self.texts):
+                if text != original:
+                    changed = True
+                    if is_tail:
+                        node.tail = text
+                    else:
+                        node.text = text
+            self.nodes.clear()
+            self.texts.clear()
+        return changed
+
+    def processElement(self, element):
+        # Update the attributes of element, returns True if one changed
+        changed = False
+        namespace, _, local_name = element.tag.rpartition('}')
+        if namespace.lstrip('{') in self.HTML_NAMESPACES:
+            # An HTML element without content such as <p></p> is not a self-closing tag
+            is_self_closing = local_name in self.VOID_ELEMENTS
+        else:
+            is_self_closing = element.text == None and len(element) == 0
+
+        # if direction is being changed, verify "calibre-chinese_text" is a class name listed in the body tag
+        if (local_name == 'body') and (self.criteria[OUTPUT_ORIENTATION] != 0):
+            classes = element.get('class')
+            if classes == None:
+                element.set('class', 'calibre-chinese_text')
+                changed = True
+            elif 'calibre-chinese_text' not in classes:
+                element.set('class', classes + ' calibre-chinese_text')
+                changed = True
+
+        # if Chinese script is being changed, change language code inside of tags. Self-closing tags
+        # are updated when HTML_TextProcessor updates them.
+        if is_self_closing:
+            update_lang = self.criteria[INPUT_SOURCE] == 0
+        else:
+            update_lang = self.converting
+        if update_lang and (self.criteria[CONVERSION_TYPE] != 0) and (self.language_code != None):
+            values = [(attribute, element.get(attribute)) for attribute in self.LANG_ATTRIBUTES]
+            values = [(attribute, value) for attribute, value in values if value != None]
+            if not any(self.zh_non_value_re.match(value) for _, value in values):
+                for attribute, value in values:
+                    if self.zh_value_re.fullmatch(value) and value != self.language_code:
+                        element.set(attribute, self.language_code)
+                        changed = True
+        return changed
+
+    def processNodeText(self, node, is_tail):
+        # Update quotes and punctuation of the text or tail of node and queue it for conversion,
+        # returns True if it changed
+        text = node.tail if is_tail else node.text
+        if text == None or text.isspace() or not self.converting:
+            return False
+        updated = self.replace_punctuation(text)
+        if updated != text:
+            if is_tail:
+                node.tail = updated
+            else:
+                node.text = updated
+        if self.criteria[CONVERSION_TYPE] != 0:
+            self.nodes.append((node, is_tail))
+            self.texts.append(updated)
+        return updated != text
+
+
 class TradSimpChinese(Tool):
     from calibre_plugins.chinese_text.resources.opencc_python.opencc import OpenCC
 
-    converter = OpenCC(get_resource_file)
+    converter = OpenCC(resource_getter, cache_size=SEGMENT_CACHE_SIZE, cache_dir=COMPILED_CACHE_DIR)
 
     # Create the HTML parser and pass in the converer
     parser = HTML_TextProcessor(converter)
@@ -360,6 +561,9 @@ class TradSimpChinese(Tool):
                     QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
                     QApplication.processEvents()
                     self.converter.set_conversion(conversion)
+                    # Compile the conversion, then drop the files read for it
+                    self.converter.prepare()
+                    resource_getter.clear()
                     self.process_files(criteria)
                     QApplication.restoreOverrideCursor()
             except Exception:
@@ -395,12 +599,9 @@ class TradSimpChinese(Tool):
                 return info_dialog(self.gui, _('Cannot Process'),
                         _('No file open for editing or the current file is not an (x)html file.'), show=True)
 
-            data = container.raw_data(name)
-            htmlstr = self.parser.processText(data, criteria)
-            if htmlstr != data:
+            if self.parser.processFile(container, name, criteria):
                 self.filesChanged = True
                 self.changed_files.append(name)
-                container.open(name, 'w').write(htmlstr)
 
         elif criteria[INPUT_SOURCE] == 0:
             # Cover the entire book
@@ -415,7 +616,7 @@ class TradSimpChinese(Tool):
 
             # Cover the text portion
             from calibre_plugins.chinese_text.resources.dialogs import ShowProgressDialog
-            d = ShowProgressDialog(self.gui, container, OEB_DOCS, criteria, self.parser.processText, _('Converting'))
+            d = ShowProgressDialog(self.gui, container, OEB_DOCS, criteria, self.parser.processFile, _('Converting'))
             cancelled_msg = ''
             if d.wasCanceled():
                 cancelled_msg = ' (cancelled)'
@@ -603,39 +804,46 @@ def set_metadata_toc(container, language, criteria, changed_files, converter):
                         item.text = language
                     if item.text != old_item:
                         opfChanged = True
+    # Texts to convert in one batch, each with the element and the attribute
+    # holding it (None for the element text)
+    opf_items = []
     # Update the creator text and file-as attribute
     items = container.opf_xpath('//opf:metadata/dc:creator')
-    if len(items) > 0:
-        for item in items:
-            old_item = item.text
-            if (item.text != None):
-                item.text = converter.convert(item.text)
-                if item.text != old_item:
-                    opfChanged = True
-            for attribute in item.attrib: # update file-as attribute
-                item.attrib[attribute] = converter.convert(item.attrib[attribute])
-    # Update the remaining dc items using a loop
+    for item in items:
+        if (item.text != None):
+            opf_items.append((item, None))
+        for attribute in item.attrib: # update file-as attribute
+            opf_items.append((item, attribute))
+    # Update the remaining dc items
     for dc_item in dc_list:
         items = container.opf_xpath(dc_item)
-        if len(items) > 0:
-            for item in items:
-                old_item = item.text
-                if (item.text != None):
-                    item.text = converter.convert(item.text)
-                    if item.text != old_item:
-                        opfChanged = True
+        for item in items:
+            if (item.text != None):
+                opf_items.append((item, None))
 
-    # Update the TOC - Do this after modifying the OPF data
+    # Update the TOC
     # Just grab all <text> fields (AKA "title" attribute in a TOC object)
     # and convert to the desired Chinese. Let Calibre set the title and
-    # language automatically from the OPF file modified earlier
+    # language automatically from the OPF file modified here
     book_toc = get_toc(container)
-    for item in book_toc.iterdescendants():
-        if(item.title != None):
-            old_title = item.title
-            item.title = converter.convert(item.title)
-            if old_title != item.title:
-                tocChanged = True
+    toc_items = [item for item in book_toc.iterdescendants() if item.title != None]
+
+    texts = [item.text if attribute == None else item.attrib[attribute] for item, attribute in opf_items]
+    texts += [item.title for item in toc_items]
+    converted = converter.convert_many(texts)
+
+    for (item, attribute), text in zip(opf_items, converted):
+        if attribute == None:
+            if item.text != text:
+                item.text = text
+                opfChanged = True
+        elif item.attrib[attribute] != text:
+            item.attrib[attribute] = text
+            opfChanged = True
+    for item, title in zip(toc_items, converted[len(opf_items):]):
+        if item.title != title:
+            item.title = title
+            tocChanged = True
 
     # Update the files with the changes
     if tocChanged:
@@ -974,7 +1182,9 @@ def cli_get_criteria(args):
 
 def cli_process_files(criteria, container, converter, parser):
     lang = get_language_code(criteria)
-    if lang != "None":
+    if isinstance(parser, LXML_TextProcessor):
+        parser.setLanguageCode(lang if lang != "None" else None)
+    elif lang != "None":
         language = 'lang=\"' + lang + '\"'
         parser.setLanguageAttribute(language)
     else:
@@ -994,11 +1204,7 @@ def cli_process_files(criteria, container, converter, parser):
     file_list = [i[0] for i in container.mime_map.items() if i[1] in OEB_DOCS]
     clean = True
     for name in file_list:
-        data = container.raw_data(name)
-        htmlstr = parser.processText(data, criteria)
-        if htmlstr != data:
-            container.dirty(name)
-            container.open(name, 'w').write(htmlstr)
+        if parser.processFile(container, name, criteria):
             changed_files.append(name)
             clean = False
 
@@ -1057,10 +1263,7 @@ def main(argv, plugin_version, usage=None):
     import argparse
     import glob
 
-    converter = OpenCC(get_resource_file)
-
-    # Create the HTML parser and pass in the converter
-    html_parser = HTML_TextProcessor(converter)
+    converter = OpenCC(resource_getter, cache_size=SEGMENT_CACHE_SIZE, cache_dir=COMPILED_CACHE_DIR)
 
     criteria = None
 
@@ -1103,11 +1306,22 @@ def main(argv, plugin_version, usage=None):
                         action='store_true')
     parser.add_argument('-s', '--show', dest='show_opt', help=_('Show the settings based on user cmdline options and exit (Default: False)'),
                         action='store_true')
+    parser.add_argument('--stats', dest='stats_opt', help=_('Print dictionary and mapping statistics after converting (Default: False)'),
+                        action='store_true')
+    parser.add_argument('--lxml', dest='lxml_opt', help=_('Convert the book\'s lxml trees in place instead of parsing the raw HTML of each file.'
+                                                          ' Changed files are written by lxml (Default: False)'),
+                        action='store_true')
     parser.add_argument('ebookFiles', metavar='ebook-filepath', nargs='+',
                         help=_('One or more epub and/or azw3 ebook filepaths - UNIX style wildcards accepted'))
 
     args = parser.parse_args(argv)
 
+    # Create the HTML processor and pass in the converter
+    if args.lxml_opt:
+        html_parser = LXML_TextProcessor(converter)
+    else:
+        html_parser = HTML_TextProcessor(converter)
+
     #Pull out the list of ebooks
     file_set = set()
 
@@ -1168,7 +1382,8 @@ def main(argv, plugin_version, usage=None):
         if args.verbose_opt and not args.quiet_opt:
             print(_('Using opencc-python conversion configuration file: ') + conversion + '.json')
         converter.set_conversion(conversion)
-##        converter.clear_counts()
+        if args.stats_opt:
+            converter.enable_stats()
 
     #Print out the conversion info
     if not args.quiet_opt:
@@ -1192,6 +1407,10 @@ def main(argv, plugin_version, usage=None):
             print(_('No ebook files specified!'))
             return(0)
 
+    # Compile the conversion, then drop the files read for it
+    converter.prepare()
+    resource_getter.clear()
+
     #Loop through the filenames
     for filename in file_set:
         #Print out the current operation
@@ -1237,6 +1456,11 @@ def main(argv, plugin_version, usage=None):
                 if not args.test_opt:
                     container.commit(outpath=output_path)
 
+    if args.stats_opt and (converter.stats is not None) and not args.quiet_opt:
+        print(_('Conversion statistics:'))
+        segment_cache = converter.segment_cache
+        print(converter.stats.report(cache_stats=segment_cache.stats() if segment_cache is not None else None))
+
     return(0)
 
 
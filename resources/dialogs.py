@@ -51,15 +51,12 @@ class ShowProgressDialog(QProgressDialog):
         if self.i >= self.total_count:
             return self.do_close()
         name = self.file_list[self.i]
-        data = self.container.raw_data(name)
         self.i += 1
 
         self.setLabelText('{0}: {1}'.format(self.action_type, name))
-        # Send the necessary data to the callback function in main.py.
-        htmlstr = self.callback_fn(data, self.criteria)
-        if htmlstr != data:
-            self.container.open(name, 'w').write(htmlstr)
-            self.container.dirty(name)
+        # Send the necessary data to the callback function in main.py. It updates the file and
+        # returns True if it changed.
+        if self.callback_fn(self.container, name, self.criteria):
             self.changed_files.append(name)
             self.clean = False
 
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+##########################################################
+# Author: Hopkins
+# Apache License Version 2.0, January 2004
+# - Convert from asyncio code without blocking the event loop. Conversions run
+#   in a thread or process executor.
+# - Small requests made at the same time are converted together in one batch
+# - The number of requests waiting to be converted is bounded, so callers wait
+#   when the executor falls behind
+# - Every batch uses the same compiled conversion: the converter's own for
+#   threads, one converter built when each worker process starts for processes
+##########################################################
+
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .opencc import OpenCC
+
+# Default largest number of requests converted in one batch
+DEFAULT_BATCH_SIZE = 64
+
+# Default largest number of requests waiting for a batch
+DEFAULT_QUEUE_SIZE = 1024
+
+# Default largest number of batches converted at once
+DEFAULT_CONCURRENCY = 4
+
+# The converter of a worker process, see AsyncOpenCC.with_processes
+_worker_converter = None
+
+
+def _init_worker(resource_getter, conversion, options):
+    global _worker_converter
+    _worker_converter = OpenCC(resource_getter, conversion, **options)
+
+
+def _worker_convert_many(strings):
+    return _worker_converter.convert_many(strings)
+
+
+class AsyncOpenCC:
+    """
+    asyncio front end of an OpenCC converter. Requests are queued and taken
+    off the queue in batches of up to batch_size, each batch converted by one
+    convert_many call in the executor. A batch holds the requests that arrived
+    while the previous batches were being converted, so a lone request is not
+    delayed.
+
+    Use AsyncOpenCC(converter) to convert in threads with a converter compiled
+    once, or AsyncOpenCC.with_processes() to convert in worker processes.
+    """
+    __slots__ = ('executor', 'batch_size', 'queue_size', 'concurrency', 'batches', '_convert_many',
+                 '_owns_executor', '_queue', '_slots', '_batcher', '_tasks')
+
+    def __init__(self, converter, executor=None, batch_size=DEFAULT_BATCH_SIZE, queue_size=DEFAULT_QUEUE_SIZE,
+                 concurrency=DEFAULT_CONCURRENCY):
+        """
+        :param converter: the OpenCC converter, shared by the threads of the
+                          executor
+        :param executor: concurrent.futures.ThreadPoolExecutor, None for the
+                         default executor of the event loop
+        :param batch_size: largest number of requests converted in one batch
+        :param queue_size: largest number of requests waiting for a batch
+        :param concurrency: largest number of batches converted at once
+        """
+        if isinstance(executor, ProcessPoolExecutor):
+            raise ValueError('use AsyncOpenCC.with_processes for a process executor')
+        # Compile the conversion now rather than in the first batch
+        converter.prepare()
+        self._setup(converter.convert_many, executor, False, batch_size, queue_size, concurrency)
+
+    @classmethod
+    def with_processes(cls, resource_getter, conversion, max_workers=None, batch_size=DEFAULT_BATCH_SIZE,
+                       queue_size=DEFAULT_QUEUE_SIZE, concurrency=None, **options):
+        """
+        Create a front end converting in worker processes. Each process builds
+        one OpenCC converter when it starts and uses it for all its batches.
+        The executor is shut down by close().
+        :param resource_getter: the resource getter of OpenCC. It must be a
+                                module level function.
+        :param conversion: the conversion, see OpenCC
+        :param max_workers: number of worker processes, None for the CPU count
+        :param batch_size: largest number of requests converted in one batch
+        :param queue_size: largest number of requests waiting for a batch
+        :param concurrency: largest number of batches converted at once, None
+                            for the number of worker processes
+        :param options: other keyword parameters of OpenCC, such as engine or
+                        cache_dir
+        :return: AsyncOpenCC
+        """
+        executor = ProcessPoolExecutor(max_workers, initializer=_init_worker,
+                                       initargs=(resource_getter, conversion, options))
+        if concurrency is None:
+            concurrency = max_workers or os.cpu_count() or 1
+        self = cls.__new__(cls)
+        self._setup(_worker_convert_many, executor, True, batch_size, queue_size, concurrency)
+        return self
+
+    def _setup(self, convert_many, executor, owns_executor, batch_size, queue_size, concurrency):
+        if batch_size < 1 or queue_size < 1 or concurrency < 1:
+            raise ValueError('batch_size, queue_size and concurrency must be at least 1')
+        self.executor = executor
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        # Number of batches converted
+        self.batches = 0
+        self._convert_many = convert_many
+        self._owns_executor = owns_executor
+        # Made in the event loop by the first request
+        self._queue = None
+        self._slots = None
+        self._batcher = None
+        # Batches being converted. The event loop only keeps weak references.
+        self._tasks = set()
+
+    async def convert(self, string):
+        """
+        Convert string, waiting if queue_size requests are already queued
+        :param string: the input string
+        :return: converted string
+        """
+        if self._batcher is None:
+            self._queue = asyncio.Queue(self.queue_size)
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._batcher = asyncio.get_running_loop().create_task(self._run_batches())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((string, future))
+        return await future
+
+    async def convert_many(self, strings):
+        """
+        Convert strings. They are queued one by one and can share batches with
+        other requests.
+        :param strings: iterable of strings
+        :return: list of the converted strings in the same order
+        """
+        return list(await asyncio.gather(*[self.convert(string) for string in strings]))
+
+    async def _run_batches(self):
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            await self._slots.acquire()
+            # Add the requests that arrived while waiting for a free slot
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            task = asyncio.get_running_loop().create_task(self._convert_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _convert_batch(self, batch):
+        try:
+            batch = [(string, future) for string, future in batch if not future.cancelled()]
+            if batch:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self._convert_many, [string for string, _ in batch])
+                self.batches += 1
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        finally:
+            self._slots.release()
+
+    async def close(self):
+        """
+        Stop taking requests off the queue and shut down the executor if it
+        was created by with_processes. Requests still queued are cancelled.
+        :return: None
+        """
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            while not self._queue.empty():
+                self._queue.get_nowait()[1].cancel()
+            self._batcher = None
+        if self._owns_executor:
+            await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+##########################################################
+# Author: Hopkins
+# Apache License Version 2.0, January 2004
+# - Size bounded least recently used cache of converted segments
+##########################################################
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Least recently used cache holding at most maxsize entries. Counts hits,
+    misses and evictions. Safe to use from several threads.
+    """
+    __slots__ = ('maxsize', 'hits', 'misses', 'evictions', '_data', '_lock')
+
+    def __init__(self, maxsize):
+        """
+        :param maxsize: the maximum number of entries, must be at least 1
+        """
+        if maxsize < 1:
+            raise ValueError('cache size must be at least 1')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: the cache key
+        :return: the cached value or None
+        """
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Add an entry, evicting the least recently used one if the cache is full
+        :param key: the cache key
+        :param value: the value to cache, must not be None
+        :return: None
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all entries. The counters are kept.
+        :return: None
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        :return: dict of the hits, misses, evictions, current size and maxsize
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self._data), 'maxsize': self.maxsize}
+
+    def __len__(self):
+        return len(self._data)
@@ -10,11 +10,23 @@ from __future__ import (unicode_literals, division, absolute_import,
 # January 2017 - Update to run under Python 2 by Hopkins1
 ##########################################################
 
+##########################################################
+# Revised by: Hopkins
+# Apache License Version 2.0, January 2004
+# - Also compile every config ahead of time into compiled files (artifacts)
+#   that the plugin loads instead of parsing the dictionaries. Each dictionary
+#   group is written once and shared by the configs using it.
+#   Requires Python 3.
+##########################################################
+
 import sys
 import os
 import io
+import argparse
 
 DICT_DIRECTORY = '.'
+CONFIG_DIRECTORY = os.path.join('..', 'config')
+COMPILED_DIRECTORY = os.path.join('..', 'compiled')
 
 REV_INPUTS = [
     'JPShinjitaiCharacters',
@@ -60,5 +72,54 @@ def reverse(rev_inputs=REV_INPUTS):
                 f.write(line)
 
 
+def compile_configs(conversions=None, output_directory=None):
+    """
+    Compile configs into artifacts. The artifact of each dictionary group holds
+    its dictionaries with first candidate values and its trie, the artifact of
+    each config the groups it uses, the layout of its plan and the alphabet.
+    The plugin loads the artifacts instead of reading the dictionaries while
+    the config and its dictionaries are unchanged. Run reverse() first so that
+    the Rev dictionaries are up to date.
+    :param conversions: names of the conversions, None for every config
+    :param output_directory: directory of the artifacts, None for
+                             COMPILED_DIRECTORY
+    :return: None
+    """
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    # Import the converter from the resources directory
+    sys.path.insert(0, os.path.join(dirname, '..', '..'))
+    from opencc_python.opencc import OpenCC, CONFIG_FILE, DICT_FILE
+    from opencc_python.preload import PreloadedResources
+    from opencc_python.registry import Registry
+
+    if conversions is None:
+        conversions = sorted(name[:-len('.json')] for name in os.listdir(os.path.join(dirname, CONFIG_DIRECTORY))
+                             if name.endswith('.json'))
+    if output_directory is None:
+        output_directory = os.path.join(dirname, COMPILED_DIRECTORY)
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    # Compile everything from the config and dictionary files, without compiled
+    # conversions. Share the dictionaries between configs.
+    resource_getter = PreloadedResources.from_directory(os.path.join(dirname, '..'), (CONFIG_FILE, DICT_FILE))
+    registry = Registry()
+    artifacts = {}
+    for conversion in conversions:
+        # Configs using the same dictionary group build the same artifact
+        artifacts.update(OpenCC(resource_getter, conversion, registry=registry).build_artifacts())
+    for file_name, artifact in sorted(artifacts.items()):
+        output_file = os.path.join(output_directory, file_name)
+        with io.open(output_file, 'wb') as f:
+            f.write(artifact)
+        print('%s: %d bytes' % (output_file, len(artifact)))
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reverse the variant dictionaries and compile the configs.')
+    parser.add_argument('conversions', nargs='*', help='conversions to compile, all configs if none are given')
+    parser.add_argument('--output', help='directory of the artifacts, default ' + COMPILED_DIRECTORY)
+    parser.add_argument('--no-compile', action='store_true', help='only reverse the dictionaries')
+    args = parser.parse_args()
     reverse()
+    if not args.no_compile:
+        compile_configs(args.conversions or None, args.output)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+##########################################################
+# Author: Hopkins
+# Apache License Version 2.0, January 2004
+# - Persistent cache of compiled dictionary data in a user cache directory
+# - Entries are named by a hash of the source bytes, so a changed dictionary
+#   is never served from an old entry
+# - Binary entries can be memory mapped read only and shared between processes
+# - The same compiled data can be built ahead of time and shipped with the
+#   plugin (artifacts), checked against the digest of the current sources
+# - Compiled tries are stored packed into strings and arrays (see
+#   DictTrie.to_data), so loading them runs no Python code per key
+##########################################################
+
+import hashlib
+import marshal
+import mmap
+import os
+import tempfile
+
+# Change when the layout of the cached data changes
+CACHE_FORMAT = 7
+
+# File name extension of the compiled conversions built ahead of time
+ARTIFACT_EXTENSION = '.occ'
+
+
+class CompiledCache:
+    """
+    Directory of marshal and binary files holding compiled dictionary data. An
+    entry is found by its kind and the digest of the data it was compiled
+    from. Errors reading or writing the directory are ignored, the caller then
+    compiles the data again.
+    """
+    __slots__ = ('directory',)
+
+    def __init__(self, directory):
+        """
+        :param directory: the cache directory, created when first written to
+        """
+        self.directory = directory
+
+    @staticmethod
+    def digest(*parts):
+        """
+        :param parts: bytes or str objects the cached data depends on
+        :return: hex digest of the parts, the cache format and marshal version
+        """
+        sha = hashlib.sha1(('%d.%d' % (CACHE_FORMAT, marshal.version)).encode('ascii'))
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            sha.update(b'%d:' % len(part))
+            sha.update(part)
+        return sha.hexdigest()
+
+    def _path(self, kind, digest, extension='marshal'):
+        return os.path.join(self.directory, '%s-%s.%s' % (kind, digest, extension))
+
+    def load(self, kind, digest):
+        """
+        :param kind: the kind of data, part of the file name
+        :param digest: digest of the source data
+        :return: the cached data or None
+        """
+        try:
+            with open(self._path(kind, digest), 'rb') as f:
+                return marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def save(self, kind, digest, data):
+        """
+        :param kind: the kind of data, part of the file name
+        :param digest: digest of the source data
+        :param data: marshal serializable data
+        :return: None
+        """
+        self._write(self._path(kind, digest), marshal.dumps(data))
+
+    def load_mapped(self, kind, digest):
+        """
+        :param kind: the kind of data, part of the file name
+        :param digest: digest of the source data
+        :return: read only mmap of the binary entry or None
+        """
+        try:
+            with open(self._path(kind, digest, 'bin'), 'rb') as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+    def save_mapped(self, kind, digest, data):
+        """
+        :param kind: the kind of data, part of the file name
+        :param digest: digest of the source data
+        :param data: bytes of the binary entry
+        :return: None
+        """
+        self._write(self._path(kind, digest, 'bin'), data)
+
+    def _write(self, path, data):
+        """
+        Write a file under a temporary name and rename it, so other processes
+        never read a partly written entry
+        :param path: the file path
+        :param data: bytes
+        :return: None
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError:
+            pass
+
+
+def artifact_name(name):
+    """
+    :param name: the conversion name, or the tuple of the dictionary file
+                 names of a group
+    :return: file name of its artifact
+    """
+    if isinstance(name, tuple):
+        name = '+'.join(name)
+    return name + ARTIFACT_EXTENSION
+
+
+def dump_artifact(digest, data):
+    """
+    :param digest: digest of the sources of data, see CompiledCache.digest
+    :param data: marshal serializable data
+    :return: bytes of the artifact
+    """
+    return marshal.dumps((digest, data))
+
+
+def load_artifact(artifact, digest):
+    """
+    :param artifact: bytes written by dump_artifact
+    :param digest: digest of the current sources of the data
+    :return: the data of the artifact, None if it cannot be read or was built
+             from other sources, by another cache format or marshal version
+    """
+    try:
+        artifact_digest, data = marshal.loads(artifact)
+    except (EOFError, ValueError, TypeError):
+        return None
+    return data if artifact_digest == digest else None
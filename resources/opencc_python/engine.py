@@ -0,0 +1,1039 @@
+# -*- coding: utf-8 -*-
+
+##########################################################
+# Author: Hopkins
+# Apache License Version 2.0, January 2004
+# - Compile the dictionaries used by OpenCC into key lookup tables with the
+#   lengths of the keys starting with each character
+# - Match a string against a table in a single left to right scan and
+#   resolve overlapping matches with the same "longest match anywhere first,
+#   then the text to the left and right" rule used by StringTree
+# - A group of dictionaries is compiled into one table so that the whole group
+#   is matched in a single scan
+# - A stage of a conversion chain is folded into a str.translate of the output
+#   of the stage before it when the result is known to be the same as applying
+#   the stages one after the other
+# - Tables map keys to their index in packed value and priority arrays, so the
+#   parsed dictionaries are dropped once compiled. Key prefixes are not stored.
+# - Dictionaries inserted into a group later are compiled into a small trie of
+#   their own looked up first (OverlaidTrie), the trie of the group is kept
+# - Strings that can only match single character keys are converted with
+#   str.translate, or a NumPy lookup table for long strings (vectorized)
+# - Long strings are matched in windows that end where no key can span the
+#   boundary, so time is linear in the string length
+# - A long string can be converted incrementally as it arrives (ChainStream)
+# - Optionally segment the text once by maximum matching and convert each
+#   segment on its own in every stage, as upstream OpenCC does (SegmentedChain)
+##########################################################
+
+import sys
+from array import array
+from itertools import accumulate
+
+from .vectorized import translate
+
+# Minimum number of characters matched together. Bounds the memory used for
+# the key occurrences of very long strings.
+MATCH_WINDOW = 4096
+
+# Average size in bytes of a key string of a trie, measured on the OpenCC
+# dictionaries
+KEY_SIZE = 80
+
+# Size in bytes of the int object of a base of a trie
+BASE_SIZE = 28
+
+
+class DictTrie:
+    """
+    Prefix trie compiled from a group of (max_len, map_dict) dictionary tuples.
+
+    The trie is stored flattened in a single dict mapping every key to its
+    index among the keys with the same first character. key_lengths maps the
+    first character of the keys to the ascending tuple of their lengths.
+    Walking the trie from a position in the text is a lookup of the slices of
+    those lengths only, so the key prefixes need not be stored. Equal length
+    tuples are shared.
+
+    The keys are numbered by first character: the index of a key is the base
+    of its first character in bases plus its index in table. Few characters
+    start more than 256 keys, so table holds the small ints shared by the whole
+    process rather than an int object per key. The values are packed in one
+    string, the value of index n being values[offsets[n]:offsets[n + 1]], and
+    priorities holds the position in the group of the dictionary of each key,
+    one byte per key. The trie keeps no other per key objects, so the
+    dictionaries it is compiled from need not be kept.
+
+    The bucket of a key orders the matches: keys from earlier dictionaries of
+    the group come first, and within a dictionary longer keys come first.
+    Scanning the buckets in order resolves the whole group in one pass.
+
+    A string without any of the key_starts characters cannot match at all and
+    is returned unchanged. A string without any of the phrase_starts characters
+    can only match single character keys, which never overlap. Such strings are
+    converted with str.translate and character_table instead of scanning the
+    trie.
+    """
+    __slots__ = ('max_len', 'bucket_count', 'table', 'bases', 'values', 'offsets', 'priorities', 'character_table',
+                 'phrase_starts', 'key_lengths')
+
+    def __init__(self, test_dicts):
+        """
+        :param test_dicts: list of tuples of the max key length and the
+                           dictionary, in group order. Values with several
+                           candidates separated by spaces use the first one.
+        """
+        max_len = max(test_dict[0] for test_dict in test_dicts)
+        table = {}
+        # (value, priority) tuples of the keys by first character
+        entries = {}
+        for priority, (_, map_dict) in enumerate(test_dicts):
+            for key, value in map_dict.items():
+                # Keys of an earlier dictionary in the group are kept
+                if key not in table:
+                    if len(key) == 1:
+                        # Shared with the first characters in key_lengths
+                        key = sys.intern(key)
+                    character_entries = entries.setdefault(sys.intern(key[0]), [])
+                    table[key] = len(character_entries)
+                    # multiple mapping, use the first one
+                    character_entries.append((value.split(' ')[0] if ' ' in value else value, priority))
+        bases = {}
+        values = []
+        priorities = bytearray()
+        for character, character_entries in entries.items():
+            bases[character] = len(values)
+            for value, priority in character_entries:
+                values.append(value)
+                priorities.append(priority)
+        self.max_len = max_len
+        self.bucket_count = len(test_dicts) * max_len
+        self.table = table
+        self.bases = bases
+        self.values = "".join(values)
+        self.offsets = array('I', accumulate(map(len, values), initial=0))
+        self.priorities = bytes(priorities)
+        self._index()
+
+    @property
+    def key_starts(self):
+        """
+        :return: the first characters of all keys, a set-like view
+        """
+        return self.key_lengths.keys()
+
+    def value(self, index):
+        """
+        :param index: the index of a key
+        :return: the value of the key
+        """
+        offsets = self.offsets
+        return self.values[offsets[index]:offsets[index + 1]]
+
+    def indexes(self):
+        """
+        :return: generator of the (key, index) tuples of the trie
+        """
+        bases = self.bases
+        for key, index in self.table.items():
+            yield (key, bases[key[0]] + index)
+
+    def items(self):
+        """
+        :return: generator of the (key, value) tuples of the trie
+        """
+        values = self.values
+        offsets = self.offsets
+        for key, index in self.indexes():
+            yield (key, values[offsets[index]:offsets[index + 1]])
+
+    @classmethod
+    def from_attributes(cls, attributes):
+        """
+        Create a trie from its attributes
+        :param attributes: tuple of the attributes in __slots__ order
+        :return: DictTrie
+        """
+        trie = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, attributes):
+            setattr(trie, name, value)
+        return trie
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Create a trie from the result of to_data. The tables are rebuilt from
+        the packed strings and arrays by bulk operations, no Python code runs
+        per key.
+        :param data: tuple of the packed trie
+        :return: DictTrie
+        """
+        (max_len, bucket_count, single_keys, single_indexes, phrases, phrase_indexes, characters, bases,
+         length_tuples, length_indexes, values, offsets, priorities, single_values, phrase_starts) = data
+        # Single character keys are shared with the first characters
+        table = dict(zip(map(sys.intern, single_keys), _unpack_array('I', single_indexes)))
+        table.update(zip(phrases.split('\n') if phrases else (), _unpack_array('I', phrase_indexes)))
+        characters = list(map(sys.intern, characters))
+        key_lengths = dict(zip(characters, map(length_tuples.__getitem__, _unpack_array('H', length_indexes))))
+        character_table = dict(zip(map(ord, single_keys), single_values.split('\n') if single_keys else ()))
+        return cls.from_attributes((max_len, bucket_count, table, dict(zip(characters, _unpack_array('I', bases))),
+                                    values, _unpack_array('I', offsets), priorities, character_table,
+                                    frozenset(map(sys.intern, phrase_starts)), key_lengths))
+
+    def to_data(self):
+        """
+        Pack the trie into strings and arrays, so that from_data rebuilds it
+        without running Python code per key. Keys and values never hold line
+        breaks, so the keys of a table are joined with them. Arrays are given
+        as little endian bytes.
+        :return: tuple of the packed trie, holding only types that can be
+                 serialized with marshal
+        """
+        # The single character keys are those of character_table
+        single_keys = "".join(map(chr, self.character_table))
+        phrases = [key for key in self.table if len(key) > 1]
+        characters = "".join(self.key_lengths)
+        # The length tuples are shared, so there are few different ones
+        length_tuples = tuple(dict.fromkeys(self.key_lengths.values()))
+        length_positions = {key_lens: position for position, key_lens in enumerate(length_tuples)}
+        return (self.max_len, self.bucket_count, single_keys, _pack_array('I', map(self.table.get, single_keys)),
+                "\n".join(phrases), _pack_array('I', map(self.table.get, phrases)), characters,
+                _pack_array('I', [self.bases[character] for character in characters]), length_tuples,
+                _pack_array('H', [length_positions[key_lens] for key_lens in self.key_lengths.values()]),
+                self.values, _pack_array('I', self.offsets), bytes(self.priorities),
+                "\n".join(self.character_table.values()), "".join(self.phrase_starts))
+
+    def estimated_size(self):
+        """
+        :return: estimated size in bytes of the trie
+        """
+        getsizeof = sys.getsizeof
+        size = getsizeof(self.table) + len(self.table) * KEY_SIZE + getsizeof(self.values) + getsizeof(self.offsets)
+        size += getsizeof(self.bases) + len(self.bases) * BASE_SIZE + getsizeof(self.priorities)
+        size += getsizeof(self.character_table) + getsizeof(self.phrase_starts)
+        return size + getsizeof(self.key_lengths)
+
+    def _index(self):
+        """
+        Set character_table to the str.translate table of the single character
+        keys, phrase_starts to the first characters of the longer keys,
+        key_starts to the first characters of all keys and key_lengths to the
+        lengths of the keys starting with each character
+        :return: None
+        """
+        character_table = {}
+        lengths = {}
+        for key, value in self.items():
+            if len(key) == 1:
+                character_table[ord(key)] = value
+            # Interned so that every set of characters shares one string each
+            lengths.setdefault(sys.intern(key[0]), set()).add(len(key))
+        # Share the length tuples, there are few different ones
+        shared = {}
+        key_lengths = {}
+        for character, key_lens in lengths.items():
+            key_lens = tuple(sorted(key_lens))
+            key_lengths[character] = shared.setdefault(key_lens, key_lens)
+        self.character_table = character_table
+        self.key_lengths = key_lengths
+        self.phrase_starts = frozenset(character for character, key_lens in key_lengths.items() if key_lens[-1] > 1)
+
+    def candidates(self, string):
+        """
+        Find every key occurring in string. The string is scanned in windows of
+        at least MATCH_WINDOW characters. A window only ends at a position that
+        no key occurrence spans, so keys in different windows never overlap
+        and each window can be matched on its own with the same result.
+        :param string: the input string
+        :return: generator of lists indexed by bucket of lists of
+                 (start, end, index) tuples in ascending start order, one list
+                 per window
+        """
+        table = self.table
+        key_lengths = self.key_lengths
+        bases = self.bases
+        priorities = self.priorities
+        max_len = self.max_len
+        bucket_count = self.bucket_count
+        string_len = len(string)
+        buckets = [[] for _ in range(bucket_count)]
+        window_end = MATCH_WINDOW
+        # End of the furthest reaching key found so far
+        reach = 0
+        for start in range(string_len):
+            if start >= window_end and start >= reach:
+                yield buckets
+                buckets = [[] for _ in range(bucket_count)]
+                window_end = start + MATCH_WINDOW
+            character = string[start]
+            for length in key_lengths.get(character, ()):
+                end = start + length
+                if end > string_len:
+                    break
+                index = table.get(string[start:end])
+                if index is not None:
+                    index += bases[character]
+                    buckets[priorities[index] * max_len + max_len - length].append((start, end, index))
+                    if end > reach:
+                        reach = end
+        yield buckets
+
+    def match(self, string):
+        """
+        Select the keys that StringTree.convert_tree would replace when the
+        dictionaries of the group are applied one after the other. Within a
+        dictionary the longest key wins, ties going to the leftmost one, and a
+        key is only used when it does not overlap a key already selected by
+        this or an earlier dictionary.
+        :param string: the input string
+        :return: list of (start, end, value) tuples
+        """
+        return self._select(string, self.candidates(string))
+
+    def count_match(self, string, counts):
+        """
+        Same as match, also counting the work done. The whole string is
+        matched as one window.
+        :param string: the input string
+        :param counts: Counter to add the lookups, probes, misses and
+                       replacements to
+        :return: list of (start, end, value) tuples
+        """
+        table = self.table
+        key_lengths = self.key_lengths
+        bases = self.bases
+        priorities = self.priorities
+        max_len = self.max_len
+        string_len = len(string)
+        buckets = [[] for _ in range(self.bucket_count)]
+        probes = 0
+        misses = 0
+        for start in range(string_len):
+            found = False
+            character = string[start]
+            for length in key_lengths.get(character, ()):
+                end = start + length
+                if end > string_len:
+                    break
+                probes += 1
+                index = table.get(string[start:end])
+                if index is not None:
+                    index += bases[character]
+                    buckets[priorities[index] * max_len + max_len - length].append((start, end, index))
+                    found = True
+            if not found:
+                misses += 1
+        spans = self._select(string, [buckets])
+        counts['lookups'] += string_len
+        counts['probes'] += probes
+        counts['misses'] += misses
+        counts['replacements'] += len(spans)
+        return spans
+
+    def _select(self, string, windows):
+        """
+        :param string: the input string
+        :param windows: iterable of the candidates of each window
+        :return: list of the selected (start, end, value) tuples
+        """
+        values = self.values
+        offsets = self.offsets
+        occupied = bytearray(len(string))
+        spans = []
+        for window in windows:
+            for bucket in window:
+                for start, end, index in bucket:
+                    if occupied.find(1, start, end) == -1:
+                        occupied[start:end] = b'\x01' * (end - start)
+                        spans.append((start, end, values[offsets[index]:offsets[index + 1]]))
+        return spans
+
+    def safe_cut(self, string):
+        """
+        Find the last position in string that no key occurrence spans, leaving
+        at least max_len - 1 characters after it so that no key completed by
+        text appended to string later could span it either. The text before
+        the position can then be converted on its own.
+        :param string: the input string
+        :return: the position, 0 if there is none
+        """
+        table = self.table
+        key_lengths = self.key_lengths
+        string_len = len(string)
+        limit = string_len - self.max_len + 1
+        cut = 0
+        # End of the furthest reaching key found so far
+        reach = 0
+        for start in range(min(string_len, limit) + 1):
+            if start >= reach:
+                cut = start
+            if start == string_len:
+                break
+            for length in key_lengths.get(string[start], ()):
+                end = start + length
+                if end > string_len:
+                    break
+                if end > reach and table.get(string[start:end]) is not None:
+                    reach = end
+        return cut
+
+    def convert(self, string):
+        """
+        Convert string with this trie
+        :param string: the input string
+        :return: converted string
+        """
+        if self.key_starts.isdisjoint(string):
+            return string
+        if self.phrase_starts.isdisjoint(string):
+            return translate(string, self.character_table)
+        return replace_spans(string, self.match(string))
+
+    def match_prefix(self, string, start):
+        """
+        Find the key at the start of string[start:] chosen by upstream OpenCC:
+        the longest one of the first dictionary of the group with any
+        :param string: the input string
+        :param start: the position to match at
+        :return: tuple of the end and the index of the key, None if there is
+                 no key at start
+        """
+        character = string[start]
+        key_lens = self.key_lengths.get(character)
+        if key_lens is None:
+            return None
+        table = self.table
+        string_len = len(string)
+        if self.bucket_count == self.max_len:
+            # A single dictionary, the longest key wins
+            for length in reversed(key_lens):
+                end = start + length
+                if end <= string_len:
+                    index = table.get(string[start:end])
+                    if index is not None:
+                        return (end, index + self.bases[character])
+            return None
+        priorities = self.priorities
+        base = self.bases[character]
+        match = None
+        priority = None
+        for length in key_lens:
+            end = start + length
+            if end > string_len:
+                break
+            index = table.get(string[start:end])
+            if index is not None:
+                index += base
+                if match is None or priorities[index] <= priority:
+                    match = (end, index)
+                    priority = priorities[index]
+        return match
+
+    def segment(self, string):
+        """
+        Split string by maximum matching: a key found by match_prefix is a
+        segment of its own, the text between keys is kept together
+        :param string: the input string
+        :return: list of segments
+        """
+        segments = []
+        run_start = 0
+        start = 0
+        while start < len(string):
+            match = self.match_prefix(string, start)
+            if match is None:
+                start += 1
+                continue
+            if run_start < start:
+                segments.append(string[run_start:start])
+            segments.append(string[start:match[0]])
+            start = run_start = match[0]
+        if run_start < len(string):
+            segments.append(string[run_start:])
+        return segments
+
+    def convert_segment(self, segment):
+        """
+        Convert a segment from left to right, replacing the key found by
+        match_prefix at each position
+        :param segment: the input segment
+        :return: converted segment
+        """
+        index = self.table.get(segment)
+        if index is not None:
+            index += self.bases[segment[0]]
+            if self.priorities[index] == 0:
+                # The whole segment is a key of the first dictionary
+                offsets = self.offsets
+                return self.values[offsets[index]:offsets[index + 1]]
+        result = []
+        start = 0
+        while start < len(segment):
+            match = self.match_prefix(segment, start)
+            if match is None:
+                result.append(segment[start])
+                start += 1
+            else:
+                end, index = match
+                result.append(self.value(index))
+                start = end
+        return "".join(result)
+
+
+class OverlaidTrie(DictTrie):
+    """
+    A DictTrie with more dictionaries inserted into its group. The inserted
+    dictionaries are compiled into a separate small trie, the overlay, and the
+    trie of the group is used as it is, so changing them compiles only the
+    overlay.
+
+    Every key is looked up in the overlay first, then in the base trie. A key
+    of both is taken from the earlier dictionary of the new group. The keys of
+    the overlay have negative indexes, ~n for the key of index n in the
+    overlay. priorities holds the positions in the new group of the
+    dictionaries of the base keys. key_lengths, character_table and
+    phrase_starts are those of the base updated with the overlay keys.
+    """
+    __slots__ = ('base', 'overlay')
+
+    def __init__(self, base, test_dicts):
+        """
+        :param base: DictTrie of the group
+        :param test_dicts: list of tuples of the position in the new group and
+                           the (max_len, map_dict) dictionary tuple, in
+                           ascending position order
+        """
+        inserted = dict(test_dicts)
+        count = base.bucket_count // base.max_len + len(inserted)
+        # Empty dictionaries at the positions of the base dictionaries, so
+        # that the priorities of the overlay are positions in the new group
+        overlay = DictTrie([inserted.get(position, (1, {})) for position in range(count)])
+        positions = bytes(position for position in range(count) if position not in inserted)
+        self.base = base
+        self.overlay = overlay
+        self.max_len = max(base.max_len, overlay.max_len)
+        self.bucket_count = count * self.max_len
+        self.table = base.table
+        self.bases = base.bases
+        self.values = base.values
+        self.offsets = base.offsets
+        self.priorities = bytes(base.priorities).translate(positions.ljust(256, b'\x00'))
+        key_lengths = dict(base.key_lengths)
+        for character, key_lens in overlay.key_lengths.items():
+            key_lengths[character] = tuple(sorted(set(key_lengths.get(character, ())).union(key_lens)))
+        character_table = dict(base.character_table)
+        for code, value in overlay.character_table.items():
+            if self._find(chr(code), chr(code))[0] < 0:
+                character_table[code] = value
+        self.key_lengths = key_lengths
+        self.character_table = character_table
+        self.phrase_starts = base.phrase_starts | overlay.phrase_starts
+
+    def _find(self, key, character):
+        """
+        :param key: the string to look up
+        :param character: the first character of key
+        :return: tuple of the index and the position in the group of the
+                 dictionary of key, None if key is not a key
+        """
+        overlay = self.overlay
+        index = overlay.table.get(key)
+        if index is not None:
+            index += overlay.bases[character]
+            priority = overlay.priorities[index]
+            base_index = self.table.get(key)
+            if base_index is None or self.priorities[base_index + self.bases[character]] > priority:
+                return (~index, priority)
+        index = self.table.get(key)
+        if index is None:
+            return None
+        index += self.bases[character]
+        return (index, self.priorities[index])
+
+    def value(self, index):
+        """
+        :param index: the index of a key
+        :return: the value of the key
+        """
+        if index < 0:
+            return self.overlay.value(~index)
+        return DictTrie.value(self, index)
+
+    def indexes(self):
+        """
+        :return: generator of the (key, index) tuples of the trie
+        """
+        table = self.table
+        for key, index in self.overlay.indexes():
+            if key not in table:
+                yield (key, ~index)
+        find = self._find
+        for key in table:
+            yield (key, find(key, key[0])[0])
+
+    def items(self):
+        """
+        :return: generator of the (key, value) tuples of the trie
+        """
+        for key, index in self.indexes():
+            yield (key, self.value(index))
+
+    def candidates(self, string):
+        """
+        Same as DictTrie.candidates, with the keys of the overlay
+        """
+        find = self._find
+        overlay_table = self.overlay.table
+        table = self.table
+        bases = self.bases
+        priorities = self.priorities
+        key_lengths = self.key_lengths
+        max_len = self.max_len
+        string_len = len(string)
+        buckets = [[] for _ in range(self.bucket_count)]
+        window_end = MATCH_WINDOW
+        reach = 0
+        for start in range(string_len):
+            if start >= window_end and start >= reach:
+                yield buckets
+                buckets = [[] for _ in range(self.bucket_count)]
+                window_end = start + MATCH_WINDOW
+            character = string[start]
+            for length in key_lengths.get(character, ()):
+                end = start + length
+                if end > string_len:
+                    break
+                key = string[start:end]
+                if key in overlay_table:
+                    index, priority = find(key, character)
+                else:
+                    index = table.get(key)
+                    if index is None:
+                        continue
+                    index += bases[character]
+                    priority = priorities[index]
+                buckets[priority * max_len + max_len - length].append((start, end, index))
+                if end > reach:
+                    reach = end
+        yield buckets
+
+    def count_match(self, string, counts):
+        """
+        Same as DictTrie.count_match, with the keys of the overlay
+        """
+        find = self._find
+        key_lengths = self.key_lengths
+        max_len = self.max_len
+        string_len = len(string)
+        buckets = [[] for _ in range(self.bucket_count)]
+        probes = 0
+        misses = 0
+        for start in range(string_len):
+            found_any = False
+            character = string[start]
+            for length in key_lengths.get(character, ()):
+                end = start + length
+                if end > string_len:
+                    break
+                probes += 1
+                found = find(string[start:end], character)
+                if found is not None:
+                    buckets[found[1] * max_len + max_len - length].append((start, end, found[0]))
+                    found_any = True
+            if not found_any:
+                misses += 1
+        spans = self._select(string, [buckets])
+        counts['lookups'] += string_len
+        counts['probes'] += probes
+        counts['misses'] += misses
+        counts['replacements'] += len(spans)
+        return spans
+
+    def _select(self, string, windows):
+        """
+        :param string: the input string
+        :param windows: iterable of the candidates of each window
+        :return: list of the selected (start, end, value) tuples
+        """
+        value = self.value
+        occupied = bytearray(len(string))
+        spans = []
+        for window in windows:
+            for bucket in window:
+                for start, end, index in bucket:
+                    if occupied.find(1, start, end) == -1:
+                        occupied[start:end] = b'\x01' * (end - start)
+                        spans.append((start, end, value(index)))
+        return spans
+
+    def safe_cut(self, string):
+        """
+        Same as DictTrie.safe_cut, with the keys of the overlay
+        """
+        overlay_table = self.overlay.table
+        table = self.table
+        key_lengths = self.key_lengths
+        string_len = len(string)
+        limit = string_len - self.max_len + 1
+        cut = 0
+        reach = 0
+        for start in range(min(string_len, limit) + 1):
+            if start >= reach:
+                cut = start
+            if start == string_len:
+                break
+            for length in key_lengths.get(string[start], ()):
+                end = start + length
+                if end > string_len:
+                    break
+                if end > reach and (string[start:end] in overlay_table or string[start:end] in table):
+                    reach = end
+        return cut
+
+    def match_prefix(self, string, start):
+        """
+        Same as DictTrie.match_prefix, with the keys of the overlay
+        """
+        character = string[start]
+        overlay_table = self.overlay.table
+        table = self.table
+        string_len = len(string)
+        match = None
+        priority = None
+        for length in self.key_lengths.get(character, ()):
+            end = start + length
+            if end > string_len:
+                break
+            key = string[start:end]
+            if key in overlay_table:
+                index, key_priority = self._find(key, character)
+            else:
+                index = table.get(key)
+                if index is None:
+                    continue
+                index += self.bases[character]
+                key_priority = self.priorities[index]
+            if match is None or key_priority <= priority:
+                match = (end, index)
+                priority = key_priority
+        return match
+
+    def convert_segment(self, segment):
+        """
+        Same as DictTrie.convert_segment, with the keys of the overlay
+        """
+        found = self._find(segment, segment[0]) if segment else None
+        if found is not None and found[1] == 0:
+            return self.value(found[0])
+        result = []
+        start = 0
+        while start < len(segment):
+            match = self.match_prefix(segment, start)
+            if match is None:
+                result.append(segment[start])
+                start += 1
+            else:
+                end, index = match
+                result.append(self.value(index))
+                start = end
+        return "".join(result)
+
+
+class MergedStage:
+    """
+    Two consecutive stages of a conversion chain, the second one folded into a
+    str.translate of the output of the first one.
+
+    If the output of the first stage has no character that is the start of a
+    phrase key of the second stage, only single character keys of the second
+    stage can match. The second stage then maps every character on its own,
+    which is the same as translating the output with its character_table. No
+    table is built for the merged stages.
+
+    guard holds the characters of the input that might lead to a phrase of the
+    second stage being present in the output of the first stage: the phrase
+    start characters themselves and the characters of every key of the first
+    stage whose value contains one. Strings containing any of them are converted
+    by the two stages in sequence.
+    """
+    __slots__ = ('guard', 'stages')
+
+    def __init__(self, first, second):
+        """
+        :param first: the DictTrie of the earlier stage
+        :param second: the DictTrie of the later stage
+        """
+        phrase_starts = second.phrase_starts
+        guard = set(phrase_starts)
+        for key, value in first.items():
+            if not phrase_starts.isdisjoint(value):
+                guard.update(map(sys.intern, key))
+        self.guard = frozenset(guard)
+        self.stages = (first, second)
+
+    def overlaid(self, first, second):
+        """
+        Create the stage with its tries replaced by overlaid tries of them,
+        reusing guard. The keys of an overlay of the first trie are added to
+        it, the keys of the base that the overlay replaces are kept, which
+        only converts a few more strings in sequence.
+        :param first: the first trie or an OverlaidTrie of it
+        :param second: the second trie or an OverlaidTrie of it
+        :return: MergedStage, None if the overlay of the second trie has new
+                 phrase start characters and the guard must be built again
+        """
+        phrase_starts = second.phrase_starts
+        if not phrase_starts <= self.stages[1].phrase_starts:
+            return None
+        guard = self.guard
+        if first is not self.stages[0]:
+            guard = set(guard)
+            for key, value in first.overlay.items():
+                if not phrase_starts.isdisjoint(value):
+                    guard.update(map(sys.intern, key))
+            guard = frozenset(guard)
+        stage = MergedStage.__new__(MergedStage)
+        stage.guard = guard
+        stage.stages = (first, second)
+        return stage
+
+    def convert(self, string):
+        """
+        Convert string with both stages
+        :param string: the input string
+        :return: converted string
+        """
+        if self.stages[0].key_starts.isdisjoint(string):
+            return self.stages[1].convert(string)
+        if self.guard.isdisjoint(string):
+            return translate(self.stages[0].convert(string), self.stages[1].character_table)
+        for stage in self.stages:
+            string = stage.convert(string)
+        return string
+
+
+class SegmentedChain:
+    """
+    The tries of a whole conversion chain applied to the segments found by a
+    segmentation trie, like the mmseg segmentation of upstream OpenCC. The
+    string is segmented once and every stage converts each segment on its own
+    with DictTrie.convert_segment. Stages that cannot match are skipped and
+    stages that can only match single character keys translate the segments.
+    Results can differ from the other stages, which replace the longest match
+    anywhere first.
+    """
+    __slots__ = ('segmenter', 'stages')
+
+    def __init__(self, segmenter, stages):
+        """
+        :param segmenter: the DictTrie of the segmentation dictionaries, None
+                          to convert the whole string as one segment
+        :param stages: list of DictTrie, one per stage of the conversion chain
+        """
+        self.segmenter = segmenter
+        self.stages = tuple(stages)
+
+    def convert(self, string):
+        """
+        Convert string with every stage
+        :param string: the input string
+        :return: converted string
+        """
+        segments = self.segmenter.segment(string) if self.segmenter is not None else [string]
+        for trie in self.stages:
+            if trie.key_starts.isdisjoint(string):
+                continue
+            if trie.phrase_starts.isdisjoint(string):
+                character_table = trie.character_table
+                segments = [segment.translate(character_table) for segment in segments]
+            else:
+                segments = [trie.convert_segment(segment) for segment in segments]
+            string = "".join(segments)
+        return string
+
+
+class ChainStream:
+    """
+    Incremental conversion of a long string arriving in pieces through the
+    stages of a conversion chain. Every stage converts the text it has
+    received up to its last safe cut and passes the result on to the next
+    stage, holding back only the text after the cut.
+    """
+    __slots__ = ('tries', 'pending')
+
+    def __init__(self, plan):
+        """
+        :param plan: conversion plan from compile_chain
+        """
+        tries = plan_tries(plan)
+        self.tries = tries
+        self.pending = [''] * len(tries)
+
+    def push(self, string):
+        """
+        Add the next piece of the string
+        :param string: the next piece
+        :return: converted text that is now final
+        """
+        for n, trie in enumerate(self.tries):
+            pending = self.pending[n] + string
+            cut = trie.safe_cut(pending)
+            self.pending[n] = pending[cut:]
+            string = trie.convert(pending[:cut])
+        return string
+
+    def flush(self):
+        """
+        Convert the text still held back at the end of the string
+        :return: converted text
+        """
+        string = ''
+        for n, trie in enumerate(self.tries):
+            string = trie.convert(self.pending[n] + string)
+            self.pending[n] = ''
+        return string
+
+
+def compile_chain(tries):
+    """
+    Build the conversion plan for a chain of tries. Each stage is folded into
+    the stage before it unless that stage is already the result of a merge.
+    A stage with only single character keys is always handled by str.translate,
+    other stages fall back to sequential conversion when needed.
+    :param tries: list of DictTrie, one per stage of the conversion chain
+    :return: list of stages, each with a convert(string) method
+    """
+    stages = []
+    for trie in tries:
+        if stages and isinstance(stages[-1], DictTrie):
+            stages[-1] = MergedStage(stages[-1], trie)
+        else:
+            stages.append(trie)
+    return stages
+
+
+def replace_tries(plan, tries, segmenter=None):
+    """
+    Build the plan of a chain with some of its tries replaced by an
+    OverlaidTrie of them. Stages with none of their tries replaced are kept as
+    they are, merged stages keep their guard when they can.
+    :param plan: conversion plan from compile_chain
+    :param tries: dict of the new tries by their index in plan_tries(plan)
+    :param segmenter: the new segmentation trie of a SegmentedChain, None to
+                      keep it
+    :return: conversion plan
+    """
+    stages = []
+    index = 0
+    for stage in plan:
+        old_tries = stage.stages if isinstance(stage, (MergedStage, SegmentedChain)) else (stage,)
+        new_tries = [tries.get(index + n, trie) for n, trie in enumerate(old_tries)]
+        index += len(old_tries)
+        if isinstance(stage, SegmentedChain):
+            segmenter = segmenter if segmenter is not None else stage.segmenter
+            stages.append(SegmentedChain(segmenter, new_tries))
+        elif all(new_trie is old_trie for new_trie, old_trie in zip(new_tries, old_tries)):
+            stages.append(stage)
+        elif isinstance(stage, MergedStage):
+            merged = stage.overlaid(*new_tries)
+            # Without the guard the two tries convert in sequence
+            stages.extend([merged] if merged is not None else new_tries)
+        else:
+            stages.extend(compile_chain(new_tries))
+    return stages
+
+
+def plan_tries(plan):
+    """
+    :param plan: conversion plan from compile_chain
+    :return: list of the tries of the plan, one per stage of the conversion
+             chain
+    """
+    tries = []
+    for stage in plan:
+        if isinstance(stage, (MergedStage, SegmentedChain)):
+            tries.extend(stage.stages)
+        else:
+            tries.append(stage)
+    return tries
+
+
+def plan_to_data(plan, trie_to_data=DictTrie.to_data):
+    """
+    :param plan: conversion plan from compile_chain
+    :param trie_to_data: function returning the data of a trie
+    :return: the plan as nested tuples that can be serialized with marshal
+    """
+    data = []
+    for stage in plan:
+        if isinstance(stage, MergedStage):
+            data.append((trie_to_data(stage.stages[0]), trie_to_data(stage.stages[1]), "".join(stage.guard)))
+        elif isinstance(stage, SegmentedChain):
+            segmenter = trie_to_data(stage.segmenter) if stage.segmenter is not None else None
+            data.append((segmenter, tuple(trie_to_data(trie) for trie in stage.stages)))
+        else:
+            data.append((trie_to_data(stage),))
+    return data
+
+
+def plan_from_data(data, trie_from_data=DictTrie.from_data):
+    """
+    :param data: result of plan_to_data
+    :param trie_from_data: function creating a trie from its data
+    :return: the conversion plan
+    """
+    plan = []
+    for stage_data in data:
+        if len(stage_data) == 1:
+            plan.append(trie_from_data(stage_data[0]))
+        elif len(stage_data) == 2:
+            segmenter = trie_from_data(stage_data[0]) if stage_data[0] is not None else None
+            plan.append(SegmentedChain(segmenter, [trie_from_data(trie_data) for trie_data in stage_data[1]]))
+        else:
+            stage = MergedStage.__new__(MergedStage)
+            stage.stages = (trie_from_data(stage_data[0]), trie_from_data(stage_data[1]))
+            stage.guard = frozenset(map(sys.intern, stage_data[2]))
+            plan.append(stage)
+    return plan
+
+
+def _pack_array(typecode, values):
+    """
+    :param typecode: the array typecode
+    :param values: iterable of ints
+    :return: bytes of the little endian array of values
+    """
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack_array(typecode, data):
+    """
+    :param typecode: the array typecode
+    :param data: bytes from _pack_array
+    :return: array
+    """
+    unpacked = array(typecode, data)
+    if sys.byteorder == 'big':
+        unpacked.byteswap()
+    return unpacked
+
+
+def replace_spans(string, spans):
+    """
+    Rebuild a string with the matched spans replaced by their values
+    :param string: the input string
+    :param spans: list of non overlapping (start, end, value) tuples
+    :return: converted string
+    """
+    result = []
+    position = 0
+    for start, end, value in sorted(spans):
+        if start > position:
+            result.append(string[position:start])
+        result.append(value)
+        position = end
+    result.append(string[position:])
+    return "".join(result)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+##########################################################
+# Author: Hopkins
+# Apache License Version 2.0, January 2004
+# - Lay out the tries of a conversion plan in one flat binary file
+# - Read the tables through a memory map, so every process using the file
+#   shares the same physical pages instead of building its own dicts
+##########################################################
+
+import marshal
+import struct
+import zlib
+from array import array
+from operator import itemgetter
+
+from .engine import DictTrie, plan_from_data, plan_to_data
+
+MAPPED_MAGIC = b'OCCMAP04'
+
+# Sections are aligned to this many bytes
+_ALIGN = 8
+
+
+class MappedTable:
+    """
+    Read only open addressing hash table over a buffer, such as a memory
+    mapped file, with the same get() as the table of a DictTrie, giving the
+    index of the key in the whole trie (see ZeroBases). Keys are
+    hashed with zlib.crc32 of their UTF-8 bytes so that the layout does not
+    depend on the process.
+
+    The table is in sections: the slots holding one more than the index of an
+    entry (0 is an empty slot), the offsets of the keys and of the values in
+    the key and value blobs, one priority byte per entry and the two blobs.
+    The value offsets, priorities and values are those of the DictTrie.
+    """
+    __slots__ = ('mask', 'slots', 'key_offsets', 'value_offsets', 'priorities', 'keys', 'values')
+
+    def __init__(self, buffer, layout):
+        """
+        :param buffer: object supporting the buffer protocol holding the table
+        :param layout: tuple of the slot count, the entry count and the offset
+                       of the table in buffer
+        """
+        slot_count, count, position = layout
+        view = memoryview(buffer)
+        self.mask = slot_count - 1
+        self.slots = view[position:position + 4 * slot_count].cast('I')
+        position += 4 * slot_count
+        self.key_offsets = view[position:position + 4 * (count + 1)].cast('I')
+        position += 4 * (count + 1)
+        self.value_offsets = view[position:position + 4 * (count + 1)].cast('I')
+        position += 4 * (count + 1)
+        self.priorities = view[position:position + count]
+        position += count
+        self.keys = view[position:position + self.key_offsets[count]]
+        position += self.key_offsets[count]
+        self.values = view[position:position + self.value_offsets[count]]
+
+    def _find(self, encoded):
+        """
+        :param encoded: UTF-8 bytes of the key
+        :return: index of the entry, -1 if there is none
+        """
+        slots = self.slots
+        key_offsets = self.key_offsets
+        mask = self.mask
+        slot = zlib.crc32(encoded) & mask
+        while True:
+            entry = slots[slot] - 1
+            if entry < 0:
+                return -1
+            if self.keys[key_offsets[entry]:key_offsets[entry + 1]] == encoded:
+                return entry
+            slot = (slot + 1) & mask
+
+    def get(self, key, default=None):
+        """
+        :param key: the string to look up
+        :param default: returned if key is not a key
+        :return: the index of a key or default
+        """
+        entry = self._find(key.encode('utf-8'))
+        if entry < 0:
+            return default
+        return entry
+
+
+class MappedValues:
+    """
+    UTF-8 value blob of a MappedTable, used as the packed values of a mapped
+    DictTrie. Slicing it with the byte offsets of a value gives the value.
+    """
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __getitem__(self, key):
+        return str(self.values[key], 'utf-8')
+
+
+class ZeroBases:
+    """
+    Bases of a mapped DictTrie. Its MappedTable gives the index of a key in the
+    whole trie, so the base of every character is 0.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, character):
+        return 0
+
+
+def _pack_table(trie):
+    """
+    :param trie: DictTrie
+    :return: tuple of the slot count, the entry count and the table bytes
+    """
+    count = len(trie.table)
+    slot_count = 8
+    while slot_count < 2 * count:
+        slot_count *= 2
+    mask = slot_count - 1
+    slots = array('I', bytes(4 * slot_count))
+    key_offsets = array('I', [0])
+    value_offsets = array('I', [0])
+    keys = []
+    values = []
+    # Entries are in the order of their index in the trie
+    for key, index in sorted(trie.indexes(), key=itemgetter(1)):
+        encoded = key.encode('utf-8')
+        slot = zlib.crc32(encoded) & mask
+        while slots[slot] != 0:
+            slot = (slot + 1) & mask
+        slots[slot] = index + 1
+        keys.append(encoded)
+        key_offsets.append(key_offsets[-1] + len(encoded))
+        value = trie.value(index).encode('utf-8')
+        values.append(value)
+        value_offsets.append(value_offsets[-1] + len(value))
+    data = b''.join([slots.tobytes(), key_offsets.tobytes(), value_offsets.tobytes(),
+                     bytes(trie.priorities), b''.join(keys), b''.join(values)])
+    return (slot_count, count, data)
+
+
+def plan_to_mapped(plan, alphabet):
+    """
+    Lay out a conversion plan in one buffer for plan_from_mapped
+    :param plan: conversion plan from compile_chain
+    :param alphabet: frozenset of the characters of all keys of the plan
+    :return: bytes
+    """
+    tables = []
+    layouts = {}
+    position = 0
+
+    def trie_layout(trie):
+        nonlocal position
+        if id(trie) not in layouts:
+            slot_count, count, data = _pack_table(trie)
+            layouts[id(trie)] = (trie.max_len, trie.bucket_count, (slot_count, count, position),
+                                 trie.character_table, trie.phrase_starts, trie.key_lengths)
+            data += bytes(-len(data) % _ALIGN)
+            tables.append(data)
+            position += len(data)
+        return layouts[id(trie)]
+
+    skeleton = plan_to_data(plan, trie_layout)
+    header = marshal.dumps((alphabet, skeleton))
+    header += bytes(-(len(MAPPED_MAGIC) + 8 + len(header)) % _ALIGN)
+    start = len(MAPPED_MAGIC) + 8 + len(header)
+    return b''.join([MAPPED_MAGIC, struct.pack('<Q', start), header] + tables)
+
+
+def plan_from_mapped(buffer):
+    """
+    Create the conversion plan of a buffer written by plan_to_mapped. The
+    tries read their tables from the buffer.
+    :param buffer: object supporting the buffer protocol, such as an mmap
+    :return: tuple of the conversion plan and the alphabet
+    """
+    if buffer[:len(MAPPED_MAGIC)] != MAPPED_MAGIC:
+        raise ValueError('not a mapped conversion plan')
+    start, = struct.unpack_from('<Q', buffer, len(MAPPED_MAGIC))
+    alphabet, skeleton = marshal.loads(buffer[len(MAPPED_MAGIC) + 8:start])
+    tries = {}
+
+    def mapped_trie(layout):
+        max_len, bucket_count, (slot_count, count, position), character_table, phrase_starts, key_lengths = layout
+        if position not in tries:
+            table = MappedTable(buffer, (slot_count, count, start + position))
+            tries[position] = DictTrie.from_attributes((max_len, bucket_count, table, ZeroBases(),
+                                                  MappedValues(table.values), table.value_offsets, table.priorities,
+                                                  character_table, phrase_starts, key_lengths))
+        return tries[position]
+
+    return (plan_from_data(skeleton, mapped_trie), alphabet)
@@ -17,112 +17,586 @@
 # - Only match once per dictionary
 # - If a dictionary is configured as part of a group, only match once per group
 #   in order of the listed dictionaries
-# - Cache the results of reading a dictionary in self.dict_cache
+# - Cache the results of reading a dictionary and of compiling a conversion in
+#   a registry shared by all converters of the process. See registry.py
+# - Keep only the first candidate of a dictionary value, resolved when the
+#   dictionary is read
+# - Match with prefix tries compiled from the dictionaries (ENGINE_TRIE) instead
+#   of the substring scan (ENGINE_TREE). See engine.py
+# - Optionally keep the dictionaries and the conversion plan of each conversion
+#   in a cache directory for later runs. See diskcache.py
+# - Optionally read the compiled tries from a memory mapped file in the cache
+#   directory, shared by all processes using it (ENGINE_MAPPED). See mapped.py
+# - Optionally segment the text with the "segmentation" dictionaries of the
+#   config file and convert segment by segment like upstream OpenCC
+#   (ENGINE_MMSEG). See engine.SegmentedChain
+# - Compiled conversions (Conversion) are never changed once built, so one
+#   converter can convert in several threads at once
+# - Optionally record which dictionaries and mappings do the work. See stats.py
+# - Conversions made only of single character mappings translate whole strings,
+#   with a NumPy lookup table for long ones when NumPy is installed. See
+#   vectorized.py
+# - User dictionaries (overlays) can take precedence over a dictionary of the
+#   conversion chain. Only the overlays are compiled, into small tries looked
+#   up before the tries of their stage.
 ##########################################################
 
 import io
 import os
 import json
 import re
+import sys
+import threading
+from collections import Counter
+
+from .cache import LRUCache
+from .diskcache import CompiledCache, artifact_name, dump_artifact, load_artifact
+from .engine import (ChainStream, DictTrie, MergedStage, OverlaidTrie, SegmentedChain, compile_chain,
+                     plan_from_data, plan_to_data, plan_tries, replace_spans, replace_tries)
+from .mapped import plan_from_mapped, plan_to_mapped
+from .registry import dict_size, shared_registry
+from .stats import ConversionStats
+from .vectorized import compose_tables, translate
 
 CONFIG_FILE = 'config'
 DICT_FILE = 'dictionary'
+COMPILED_FILE = 'compiled'
+
+# Conversion engines
+ENGINE_TREE = 'tree'    # StringTree substring scan
+ENGINE_TRIE = 'trie'    # Prefix trie scan, same output as ENGINE_TREE
+ENGINE_MAPPED = 'mapped'    # ENGINE_TRIE with the tables in a shared memory mapped file
+ENGINE_MMSEG = 'mmseg'    # Maximum matching segmentation then conversion of each segment, as upstream OpenCC
+
+# Minimum number of characters converted together by ENGINE_TREE
+LONG_SEGMENT_WINDOW = 64
+
+# Pieces of text longer than this, without a boundary where ENGINE_TREE can
+# split them, are matched with a DictTrie of the group instead. The substring
+# scan of StringTree is quadratic in the length of the piece.
+LONG_SEGMENT_LIMIT = 4 * LONG_SEGMENT_WINDOW
+
+# DictTries of the groups of ENGINE_TREE by the ids of their dictionaries, each
+# kept with the group so that the ids are not reused while it is cached
+_group_tries = LRUCache(8)
+
+# Number of characters without a separator that convert_stream holds back
+# before converting them incrementally with ENGINE_TRIE
+STREAM_WINDOW = 4096
+
+# Sentence separators from OpenCC PhraseExtract.cpp, in addition to white space.
+# None of these separators are allowed as part of a dictionary entry.
+SEPARATORS = '-,.?!*　，。、；：？！…“”‘’『』「」﹁﹂—－（）《》〈〉～．／＼︒︑︔︓︿﹀︹︺︙︐［﹇］﹈︕︖︰︳︴︽︾︵︶｛︷｝︸﹃﹄【︻】︼︲'
+
+# Matches a run of separators in a single pass over a character class. Splitting
+# with it puts the text segments at the even indexes and the separator runs at
+# the odd ones.
+SEPARATOR_RE = re.compile('([\\s' + re.escape(SEPARATORS) + ']+)')
+
+class Conversion:
+    """
+    A compiled conversion. It is not changed after it is built and is shared
+    by the converters and threads using the conversion.
+    """
+    __slots__ = ('name', 'engine', 'dict_chain', 'dict_chain_data', 'trie_chain_data', 'alphabet', 'stage_alphabets',
+                 'text_table', 'segmentation')
+
+    def __init__(self, name, engine, dict_chain, dict_chain_data, trie_chain_data, alphabet, stage_alphabets=None,
+                 text_table=None, segmentation=None):
+        """
+        :param name: the name from the config file
+        :param engine: the engine the conversion was compiled for
+        :param dict_chain: the dict chain of dictionary file names
+        :param dict_chain_data: the dictionaries of the dict chain for
+                                ENGINE_TREE, empty for the other engines. Their
+                                tries hold everything they use.
+        :param trie_chain_data: the conversion plan, empty for ENGINE_TREE
+        :param alphabet: frozenset of characters, a string without any of
+                         them is not changed by the conversion. The first
+                         characters of all keys, every key character for
+                         ENGINE_TREE.
+        :param stage_alphabets: for ENGINE_TREE, list of frozensets of the
+                                characters of the keys of each item of the
+                                dict chain, else None. The tries of the other
+                                engines hold their own (DictTrie.key_starts).
+        :param text_table: translate table doing the whole conversion when every
+                           stage only has single character keys, else None
+        :param segmentation: the dict chain item of the segmentation
+                             dictionaries of the config file, None if it has
+                             none
+        """
+        self.name = name
+        self.engine = engine
+        self.dict_chain = dict_chain
+        self.dict_chain_data = dict_chain_data
+        self.trie_chain_data = trie_chain_data
+        self.alphabet = alphabet
+        self.stage_alphabets = stage_alphabets
+        self.text_table = text_table
+        self.segmentation = segmentation
 
-# Dictionary mapping ("old", "new") as a key and conversion count as a value
-_counts_dict = {}
 
 class OpenCC:
-    def __init__(self, resource_getter, conversion=None):
+    """
+    Converter between Chinese variants. Calls to the convert methods can run
+    in several threads at once: each call uses the compiled Conversion current
+    when it starts and keeps no state of its own on the converter.
+    set_conversion, set_engine and set_overlay take effect for calls starting
+    after them.
+    """
+    def __init__(self, resource_getter, conversion=None, engine=ENGINE_TRIE, cache_size=0, cache_dir=None,
+                 registry=None):
         """
         init OpenCC
         :param resource_getter: function that takes 2 parameters.
-         The first parameter is CONFIG_FILE, or DICT_FILE
+         The first parameter is CONFIG_FILE, DICT_FILE or COMPILED_FILE
          The second parameter is a file name associated with the directory.
-         It returns bytes from the selected file.
+         It returns bytes from the selected file. See
+         preload.PreloadedResources for a getter loading the files in bulk.
         :param conversion: the conversion of usage, options are
          'hk2s', 'hk2sp', 'hk2t', 'jp2t', 's2hk', 's2hkp', 's2t', 's2tw', 's2twp',
          't2hk', 't2jp', 't2s', 't2tw', 'tw2s', and 'tw2sp', 'tw2t'
          check the json file names in config directory
+        :param engine: ENGINE_TRIE (default), ENGINE_TREE, ENGINE_MAPPED or
+         ENGINE_MMSEG. ENGINE_MAPPED needs a cache_dir. ENGINE_MMSEG segments
+         the text like upstream OpenCC and can give different results.
+        :param cache_size: number of converted segments to keep in an LRU cache
+         (self.segment_cache), 0 for no cache
+        :param cache_dir: directory to keep the compiled dictionaries in between
+         runs (self.compiled_cache), None for no cache
+        :param registry: registry.Registry holding the dictionaries and compiled
+         conversions, None to share registry.shared_registry with every other
+         converter of the process
         :return: None
         """
-        _counts_dict.clear()
-        self.conversion_name = ''
         self.conversion = conversion
-        self._dict_init_done = False
-        self._dict_chain = list()
-        self._dict_chain_data = list()
-        self.dict_cache = dict()
+        self.engine = engine
+        # The compiled conversion, None until it is needed
+        self._state = None
+        # Held while the conversion or engine is changed or compiled
+        self._state_lock = threading.Lock()
+        self.registry = registry if registry is not None else shared_registry
+        # ConversionStats while statistics are recorded, see enable_stats
+        self.stats = None
+        self.segment_cache = LRUCache(cache_size) if cache_size > 0 else None
+        self.compiled_cache = CompiledCache(cache_dir) if cache_dir is not None else None
         self.resource_getter = resource_getter
-        # List of sentence separators from OpenCC PhraseExtract.cpp. None of these separators are allowed as
-        # part of a dictionary entry
-        self.split_chars_re = re.compile(
-            r'(\s+|-|,|\.|\?|!|\*|　|，|。|、|；|：|？|！|…|“|”|‘|’|『|』|「|」|﹁|﹂|—|－|（|）|《|》|〈|〉|～|．|／|＼|︒|︑|︔|︓|︿|﹀|︹|︺|︙|︐|［|﹇|］|﹈|︕|︖|︰|︳|︴|︽|︾|︵|︶|｛|︷|｝|︸|﹃|﹄|【|︻|】|︼|—|， |： |︲|～)')
+        self.split_chars_re = SEPARATOR_RE
+        # User dictionaries by name, see set_overlay
+        self.overlays = {}
         if self.conversion is not None:
-            self._init_dict()
+            self._get_state()
 
+    @property
+    def conversion_name(self):
+        """
+        :return: the name of the conversion from its config file, '' before
+                 it is compiled
+        """
+        state = self._state
+        return state.name if state is not None else ''
+
+    def prepare(self):
+        """
+        Compile the conversion now rather than on the first conversion
+        :return: None
+        """
+        self._get_state()
+
+    def _get_state(self):
+        """
+        Get the compiled conversion, compiling it on first use
+        :return: Conversion, None if no conversion is wanted
+        """
+        state = self._state
+        if state is None:
+            with self._state_lock:
+                if self.conversion == "no_conversion":
+                    return None
+                if self._state is None:
+                    self._state = self._apply_overlays(self._init_dict())
+                state = self._state
+        return state
 
     def convert(self, string):
         """
         Convert string from Simplified Chinese to Traditional Chinese or vice versa
         """
+        return self.convert_many([string])[0]
+
+    def convert_many(self, strings):
+        """
+        Convert a batch of strings. Identical strings and identical segments
+        within the batch are converted only once.
+        :param strings: iterable of strings
+        :return: list of the converted strings in the same order
+        """
+        strings = list(strings)
+        state = self._get_state()
 
         # echo the input if no conversion is wanted
-        if self.conversion == "no_conversion":
-            return string
+        if state is None:
+            return strings
+        return self._convert_many(strings, state)
 
-        if not self._dict_init_done:
-            self._init_dict()
-            self._dict_init_done = True
+    def _convert_many(self, strings, state):
+        """
+        Convert a batch of strings with a compiled conversion
+        :param strings: list of strings
+        :param state: the Conversion
+        :return: list of the converted strings in the same order
+        """
+        if state.text_table is not None and self.stats is None:
+            # Every character is converted on its own, so there is no need to
+            # separate the strings
+            converted_strings = {string: translate(string, state.text_table) for string in set(strings)}
+            return [converted_strings[string] for string in strings]
 
-        result = []
-        # Separate string using the list of separators in a regular expression
-        split_string_list = self.split_chars_re.split(string)
-        for i in range(0, len(split_string_list)):
-            if i % 2 == 0:
-                # Work with the text string
-                # Append converted string to result
-                result.append(self._convert(split_string_list[i], self._dict_chain_data))
+        # Separate each distinct string at the runs of separators. Text segments
+        # are at the even indexes, separator runs at the odd ones.
+        split_strings = {}
+        segments = {}
+        for string in strings:
+            if not string in split_strings:
+                split_string_list = self.split_chars_re.split(string)
+                split_strings[string] = split_string_list
+                segments.update(dict.fromkeys(split_string_list[::2]))
+
+        if self.stats is not None and state.engine in (ENGINE_TRIE, ENGINE_MAPPED):
+            # Statistics count every occurrence of a segment in the batch
+            occurrences = Counter()
+            for string in strings:
+                occurrences.update(split_strings[string][::2])
+            self._count_segments(segments, state, self.stats, occurrences)
+        else:
+            self._convert_segments(segments, state)
+
+        converted_strings = {}
+        for string, split_string_list in split_strings.items():
+            split_string_list[::2] = [segments[segment] for segment in split_string_list[::2]]
+            # Join it all together to return a result
+            converted_strings[string] = "".join(split_string_list)
+        return [converted_strings[string] for string in strings]
+
+    def convert_stream(self, chunks):
+        """
+        Convert text arriving as an iterable of chunks. The concatenation of the
+        converted chunks is the same as converting the concatenation of the input.
+        Only the text after the last separator is held back until more input
+        arrives. With ENGINE_TRIE or ENGINE_MAPPED a run of more than STREAM_WINDOW characters
+        without a separator is converted incrementally, holding back no more
+        than the longest dictionary key of each stage.
+        While statistics are recorded such runs are held back until the next
+        separator.
+        :param chunks: iterable of strings
+        :return: generator of converted strings
+        """
+        state = self._get_state()
+        stream_runs = state is not None and state.engine in (ENGINE_TRIE, ENGINE_MAPPED) and self.stats is None
+
+        # echo the input if no conversion is wanted
+        if state is None:
+            yield from chunks
+            return
+
+        pending = ''
+        # Incremental conversion of the current run without separators
+        stream = None
+        for chunk in chunks:
+            pending += chunk
+            last_separator = None
+            for last_separator in self.split_chars_re.finditer(pending):
+                pass
+            if last_separator is not None:
+                # Everything up to the last separator can be converted
+                complete = pending[:last_separator.end()]
+                pending = pending[last_separator.end():]
+                if stream is not None:
+                    # The run being streamed ends at the first separator
+                    run_end = self.split_chars_re.search(complete).start()
+                    yield stream.push(complete[:run_end]) + stream.flush()
+                    complete = complete[run_end:]
+                    stream = None
+                yield self._convert_many([complete], state)[0]
+            if len(pending) > STREAM_WINDOW and stream_runs:
+                if stream is None:
+                    stream = ChainStream(state.trie_chain_data)
+                converted = stream.push(pending)
+                pending = ''
+                if len(converted) > 0:
+                    yield converted
+        if stream is not None:
+            yield stream.push(pending) + stream.flush()
+        elif len(pending) > 0:
+            yield self._convert_many([pending], state)[0]
+
+    def _convert_segments(self, segments, state):
+        """
+        Convert text segments that contain no separators
+        :param segments: dict with the segments as keys. The values are set
+                         to the converted segments.
+        :param state: the Conversion
+        :return: None
+        """
+        if state.engine != ENGINE_TREE:
+            convert_function = self._convert_trie
+            chain_args = (state.trie_chain_data,)
+        else:
+            convert_function = self._convert
+            chain_args = (state.dict_chain_data, state.stage_alphabets)
+        alphabet = state.alphabet
+        cache = self.segment_cache
+        for segment in segments:
+            # Skip strings without any character of a dictionary key
+            if alphabet.isdisjoint(segment):
+                segments[segment] = segment
+            elif cache is None:
+                segments[segment] = convert_function(segment, *chain_args)
             else:
-                # Work with the separator
-                # Append separator string to converted_string
-                result.append(split_string_list[i])
-        # Join it all together to return a result
-        return "".join(result)
+                # A call still using the previous conversion must not add
+                # its results for the current one
+                key = (state, segment)
+                converted = cache.get(key)
+                if converted is None:
+                    converted = convert_function(segment, *chain_args)
+                    cache.put(key, converted)
+                segments[segment] = converted
 
-    def _convert(self, string, dictionary = [], is_dict_group = False):
+    def _count_segments(self, segments, state, stats, occurrences):
+        """
+        Convert text segments like _convert_segments with ENGINE_TRIE or
+        ENGINE_MAPPED, recording statistics for every occurrence of each
+        segment, including the segments answered by the segment cache
+        :param segments: dict with the segments as keys. The values are set
+                         to the converted segments.
+        :param state: the Conversion
+        :param stats: the ConversionStats
+        :param occurrences: Counter of the number of times each segment occurs
+        :return: None
+        """
+        names = ['+'.join(self._flatten_chain(item)) for item in state.dict_chain]
+        cache = self.segment_cache
+        for segment in segments:
+            if cache is None:
+                counted = self._convert_counted(segment, state, names)
+            else:
+                # The counts are cached with the converted segment, apart from
+                # the converted segments cached without statistics
+                key = (state, segment, ConversionStats)
+                counted = cache.get(key)
+                if counted is None:
+                    counted = self._convert_counted(segment, state, names)
+                    cache.put(key, counted)
+            segments[segment], counts = counted
+            # Empty segments between separators are not counted
+            if len(segment) > 0:
+                stats.add(*counts, count=occurrences[segment])
+
+    def _convert(self, string, dictionary = [], alphabets = None):
         """
         Convert string from Simplified Chinese to Traditional Chinese or vice versa
         If a dictionary is part of a group of dictionaries, stop conversion on a word
         after the first match is found.
         :param string: the input string
-        :param dictionary: list of dictionaries to be applied against the string
-        :param is_dict_group: indicates if this is a group of dictionaries in which only
-                              the first match in the dict group should be used
+        :param dictionary: list of dictionaries to be applied against the string.
+                           A list inside the list is a group of dictionaries in
+                           which only the first match in the dict group is used
+        :param alphabets: list of frozensets of the key characters of each item
+                          of dictionary, used to skip the items that cannot match
         :return: converted string
         """
-        tree = StringTree(string)
-        for c_dict in dictionary:
-            if isinstance(c_dict, tuple):
-                tree.convert_tree(c_dict)
-                if not is_dict_group:
-                    # Don't reform the string here if the dictionary list is part of a group
-                    # Recreate the tree for next loop iteration
-                    tree = StringTree("".join(tree.inorder()))
+        for index, c_dict in enumerate(dictionary):
+            if alphabets is not None and alphabets[index].isdisjoint(string):
+                continue
+            group = self._flatten_chain(c_dict)
+            result = []
+            for piece in self._split_long(string, group):
+                if len(piece) > LONG_SEGMENT_LIMIT:
+                    result.append(self._group_trie(group).convert(piece))
+                    continue
+                tree = StringTree(piece)
+                for group_dict in group:
+                    tree.convert_tree(group_dict)
+                result.extend(tree.inorder())
+            string = "".join(result)
+        return string
+
+    def _group_trie(self, group):
+        """
+        :param group: list of dictionaries applied together
+        :return: DictTrie of the group, giving the same result as StringTree
+        """
+        key = tuple(id(test_dict) for test_dict in group)
+        cached = _group_tries.get(key)
+        if cached is None or any(a is not b for a, b in zip(cached[0], group)):
+            cached = (tuple(group), DictTrie(group))
+            _group_tries.put(key, cached)
+        return cached[1]
+
+    def _split_long(self, string, group):
+        """
+        Split a long string into pieces of at least LONG_SEGMENT_WINDOW characters.
+        A piece only ends at a position that no key of the group can span, so
+        each piece can be converted on its own with the same result. Pieces
+        stay short when the text has boundaries often, as real text does. A
+        piece can be as long as the string when it has none, see
+        LONG_SEGMENT_LIMIT.
+        :param string: the input string
+        :param group: list of dictionaries applied together
+        :return: list of strings
+        """
+        max_len = max(test_dict[0] for test_dict in group)
+        pieces = []
+        piece_start = 0
+        position = LONG_SEGMENT_WINDOW
+        while position < len(string):
+            if self._is_boundary(string, position, group, max_len):
+                pieces.append(string[piece_start:position])
+                piece_start = position
+                position += LONG_SEGMENT_WINDOW
             else:
-                # This is a list of dictionaries. Call back in with the dictionary
-                # list but specify that this is a group
-                tree = StringTree(self._convert("".join(tree.inorder()), c_dict, True))
-        return "".join(tree.inorder())
+                position += 1
+        pieces.append(string[piece_start:])
+        return pieces
+
+    def _is_boundary(self, string, position, group, max_len):
+        """
+        :return: True if no key of the group occurs across position in string
+        """
+        for start in range(max(0, position - max_len + 1), position):
+            for end in range(position + 1, min(len(string), start + max_len) + 1):
+                for test_dict in group:
+                    if string[start:end] in test_dict[1]:
+                        return False
+        return True
+
+    def _convert_trie(self, string, dictionary):
+        """
+        Convert string using the prefix tries compiled from the dictionaries.
+        Gives the same result as _convert.
+        :param string: the input string
+        :param dictionary: conversion plan from engine.compile_chain
+        :return: converted string
+        """
+        for stage in dictionary:
+            string = stage.convert(string)
+        return string
+
+    def _convert_counted(self, string, state, names):
+        """
+        Convert string with the trie of each stage of the conversion chain in
+        turn, counting the work done. Gives the same result as _convert_trie.
+        :param string: the input string
+        :param state: the Conversion
+        :param names: list of the dictionary names of each stage
+        :return: tuple of the converted string and the parameters of
+                 ConversionStats.add for one occurrence of string
+        """
+        length = len(string)
+        mappings = Counter()
+        dictionaries = {}
+        for name, trie in zip(names, plan_tries(state.trie_chain_data)):
+            counts = dictionaries.setdefault(name, Counter())
+            if trie.key_starts.isdisjoint(string):
+                counts['skipped'] += 1
+            elif trie.phrase_starts.isdisjoint(string):
+                counts['translated'] += 1
+                character_table = trie.character_table
+                for character in string:
+                    value = character_table.get(ord(character))
+                    if value is not None:
+                        mappings[(character, value)] += 1
+                        counts['replacements'] += 1
+                string = string.translate(character_table)
+            else:
+                spans = trie.count_match(string, counts)
+                for start, end, value in spans:
+                    mappings[(string[start:end], value)] += 1
+                string = replace_spans(string, spans)
+        return (string, (length, mappings, dictionaries))
 
     def _init_dict(self):
         """
-        initialize the dict with chosen conversion
-        :return: None
+        initialize the dict with chosen conversion. The compiled conversion is
+        taken from self.registry when another converter has already built it.
+        :return: Conversion
         """
         if self.conversion is None:
             raise ValueError('conversion is not set')
 
-        self._dict_chain = []
+        cache_dir = self.compiled_cache.directory if self.compiled_cache is not None else None
+        key = (CONFIG_FILE, self.resource_getter, self.conversion, self.engine, cache_dir)
+        return self.registry.get(key, self._compile_conversion)
+
+    def _apply_overlays(self, state):
+        """
+        Insert self.overlays into the stages of a compiled conversion. Only the
+        overlays are compiled, the tries of state are overlaid with them and
+        the dictionaries of ENGINE_TREE are grouped with them. state is not
+        changed.
+        :param state: the Conversion from self.registry
+        :return: Conversion
+        """
+        if not self.overlays:
+            return state
+        dict_chain = []
+        dict_chain_data = list(state.dict_chain_data)
+        stage_alphabets = list(state.stage_alphabets) if state.stage_alphabets is not None else None
+        base_tries = plan_tries(state.trie_chain_data)
+        tries = {}
+        alphabet = set(state.alphabet)
+        for index, item in enumerate(state.dict_chain):
+            group, positions = self._overlay_group(item)
+            if not positions:
+                dict_chain.append(item)
+                continue
+            for _, test_dict in positions:
+                alphabet.update("".join(test_dict[1]))
+            dict_chain.append(group)
+            if state.engine == ENGINE_TREE:
+                base_data = iter(self._flatten_chain(state.dict_chain_data[index]))
+                overlay_data = dict(positions)
+                group_data = [overlay_data[position] if position in overlay_data else next(base_data)
+                              for position in range(len(group))]
+                dict_chain_data[index] = group_data
+                stage_alphabets[index] = self._chain_alphabet(group_data)
+            else:
+                tries[index] = OverlaidTrie(base_tries[index], positions)
+        segmenter = None
+        if state.engine == ENGINE_MMSEG and state.segmentation is not None:
+            # Keys of the overlays of the segmentation dictionaries are segments
+            _, positions = self._overlay_group(state.segmentation)
+            if positions:
+                segmenter = OverlaidTrie(state.trie_chain_data[0].segmenter, positions)
+        trie_chain_data = replace_tries(state.trie_chain_data, tries, segmenter)
+        return Conversion(state.name, state.engine, dict_chain, dict_chain_data, trie_chain_data, frozenset(alphabet),
+                          stage_alphabets, self._text_table(trie_chain_data), state.segmentation)
+
+    def _overlay_group(self, item):
+        """
+        Insert self.overlays into a dict chain item, each one just before its
+        dictionary
+        :param item: a dict chain item of dictionary file names
+        :return: tuple of the list of the names of the group with the overlays
+                 and the list of the (position in the group, dictionary tuple)
+                 of each overlay inserted
+        """
+        group = []
+        positions = []
+        for base_name in self._flatten_chain(item):
+            for name, (dictionary, test_dict) in self.overlays.items():
+                if dictionary == base_name:
+                    positions.append((len(group), test_dict))
+                    group.append(name)
+            group.append(base_name)
+        return (group, positions)
+
+    def _compile_conversion(self):
+        """
+        Read the config file of self.conversion and compile the conversion
+        :return: tuple of the Conversion and its estimated size in bytes
+        """
+        dict_chain = []
 ##        print(self.conversion)
         config = self.conversion + '.json'
 ##        print(config)
@@ -132,45 +606,390 @@ class OpenCC:
         else:
             raise IOError('unable to open opencc config file')
 
-        self.conversion_name = setting_json.get('name')
+        conversion_name = setting_json.get('name')
 
         for chain in setting_json.get('conversion_chain'):
-            self._add_dict_chain(self._dict_chain, chain.get('dict'))
+            self._add_dict_chain(dict_chain, chain.get('dict'))
+
+        segmentation = None
+        segmentation_json = setting_json.get('segmentation')
+        if segmentation_json is not None and segmentation_json.get('type') == 'mmseg':
+            segmentation_chain = []
+            self._add_dict_chain(segmentation_chain, segmentation_json.get('dict'))
+            if segmentation_chain:
+                segmentation = segmentation_chain[0]
+
+        dict_chain_data = []
+        stage_alphabets = None
+        if self.engine == ENGINE_MAPPED:
+            trie_chain_data, alphabet = self._map_plan(dict_chain, segmentation, bytes)
+        elif self.engine == ENGINE_TREE:
+            self._add_dictionaries(dict_chain, dict_chain_data)
+            stage_alphabets = [self._chain_alphabet([item]) for item in dict_chain_data]
+            alphabet = frozenset().union(*stage_alphabets)
+            trie_chain_data = []
+        else:
+            trie_chain_data, alphabet = self._compile_plan(dict_chain, segmentation, bytes)
+
+        text_table = self._text_table(trie_chain_data)
 
-        self._dict_chain_data = []
-        self._add_dictionaries(self._dict_chain, self._dict_chain_data)
-        self._dict_init_done = True
+        # The dictionaries and tries have their own registry entries
+        size = sys.getsizeof(alphabet) + sys.getsizeof(text_table)
+        if stage_alphabets is not None:
+            size += sum(sys.getsizeof(stage_alphabet) for stage_alphabet in stage_alphabets)
+        for stage in trie_chain_data:
+            if isinstance(stage, MergedStage):
+                size += sys.getsizeof(stage.guard)
+            elif self.engine == ENGINE_MAPPED:
+                size += sys.getsizeof(stage.character_table)
+        return (Conversion(conversion_name, self.engine, dict_chain, dict_chain_data, trie_chain_data, alphabet,
+                           stage_alphabets, text_table, segmentation), size)
+
+    def _compile_plan(self, dict_chain, segmentation, config_bytes):
+        """
+        Compile the conversion plan of ENGINE_TRIE or ENGINE_MMSEG, taking it
+        from self.compiled_cache or the artifacts of the conversion when they
+        have it
+        :param dict_chain: the dict chain of dictionary file names
+        :param segmentation: the dict chain item of the segmentation
+                             dictionaries or None
+        :param config_bytes: the contents of the config file
+        :return: tuple of the conversion plan and the alphabet
+        """
+        digest = None
+        if self.compiled_cache is not None:
+            digest_chain = dict_chain
+            if self.engine == ENGINE_MMSEG and segmentation is not None:
+                digest_chain = dict_chain + [segmentation]
+            digest = self._compiled_digest(digest_chain, config_bytes)
+            compiled = self.compiled_cache.load(CONFIG_FILE, digest)
+            if compiled is not None:
+                plan_data, alphabet = compiled
+                return (plan_from_data(plan_data), frozenset(map(sys.intern, alphabet)))
+        plan = None
+        groups = {}
+        compiled = self._load_artifact(dict_chain, segmentation, config_bytes)
+        if compiled is not None:
+            plan_data, alphabet, group_tries = compiled
+            alphabet = frozenset(map(sys.intern, alphabet))
+            if self.engine == ENGINE_TRIE:
+                # Artifacts hold the plan of ENGINE_TRIE
+                plan = plan_from_data(plan_data, lambda position: self._get_trie(*group_tries[position]))
+            else:
+                groups = dict(group_tries)
+        if plan is None:
+            tries = []
+            self._add_tries(dict_chain, tries, groups)
+            if self.engine == ENGINE_TRIE:
+                plan = compile_chain(tries)
+            else:
+                segmenter = []
+                if segmentation is not None:
+                    self._add_tries([segmentation], segmenter, groups)
+                plan = [SegmentedChain(segmenter[0] if segmenter else None, tries)]
+            if compiled is None:
+                alphabet = self._plan_alphabet(plan)
+        if digest is not None:
+            self.compiled_cache.save(CONFIG_FILE, digest, (plan_to_data(plan), "".join(alphabet)))
+        return (plan, alphabet)
+
+    def _text_table(self, trie_chain_data):
+        """
+        :param trie_chain_data: the conversion plan
+        :return: translate table of the whole plan if no stage has phrase keys,
+                 else None. Separators are never converted and are left out.
+        """
+        tries = plan_tries(trie_chain_data)
+        if not tries or any(trie.phrase_starts for trie in tries):
+            return None
+        text_table = compose_tables([trie.character_table for trie in tries])
+        return {code: value for code, value in text_table.items()
+                if self.split_chars_re.fullmatch(chr(code)) is None}
+
+    def _map_plan(self, dict_chain, segmentation, config_bytes):
+        """
+        Map the compiled tries of the conversion from self.compiled_cache,
+        writing them first from the artifact of the conversion, or from the
+        dictionaries if there is none, if they are not there yet. A converter
+        finding them there does not read the dictionaries at all.
+        :param dict_chain: the dict chain of dictionary file names
+        :param segmentation: the dict chain item of the segmentation
+                             dictionaries or None
+        :param config_bytes: the contents of the config file
+        :return: tuple of the conversion plan and the alphabet
+        """
+        if self.compiled_cache is None:
+            raise ValueError('ENGINE_MAPPED needs a cache_dir')
+        digest = self._compiled_digest(dict_chain, config_bytes)
+        buffer = self.compiled_cache.load_mapped(CONFIG_FILE, digest)
+        if buffer is None:
+            compiled = self._load_artifact(dict_chain, segmentation, config_bytes)
+            if compiled is not None:
+                # The artifact holds the plan of ENGINE_TRIE, which has the same tries
+                plan_data, alphabet, groups = compiled
+                plan = plan_from_data(plan_data, lambda position: DictTrie.from_data(groups[position][1]))
+                alphabet = frozenset(alphabet)
+            else:
+                tries = []
+                self._add_tries(dict_chain, tries)
+                plan = compile_chain(tries)
+                alphabet = self._plan_alphabet(plan)
+            buffer = plan_to_mapped(plan, alphabet)
+            self.compiled_cache.save_mapped(CONFIG_FILE, digest, buffer)
+            # Use the file so that the pages are shared with other processes
+            buffer = self.compiled_cache.load_mapped(CONFIG_FILE, digest) or buffer
+        return plan_from_mapped(buffer)
+
+    def _load_artifact(self, dict_chain, segmentation, config_bytes):
+        """
+        Read the compiled conversion built ahead of time by build_artifacts
+        through the resource getter, with the artifacts of its dictionary groups
+        :param dict_chain: the dict chain of dictionary file names
+        :param segmentation: the dict chain item of the segmentation
+                             dictionaries or None
+        :param config_bytes: the contents of the config file
+        :return: tuple of the plan data of ENGINE_TRIE, the characters of the
+                 alphabet in a string and the list of the groups the plan
+                 data refers to by position in place of each trie, as tuples
+                 of the dictionary file names and the trie data (see
+                 _get_trie). None if an artifact is missing or the config
+                 file or a dictionary changed since it was built.
+        """
+        artifact_chain = dict_chain + [segmentation] if segmentation is not None else dict_chain
+        digest, group_digests = self._artifact_digests(artifact_chain, config_bytes)
+        compiled = self._read_artifact(self.conversion, digest)
+        if compiled is None:
+            return None
+        groups, plan_data, alphabet = compiled
+        group_tries = []
+        for names in groups:
+            trie_data = self._read_artifact(names, group_digests[names]) if names in group_digests else None
+            if trie_data is None:
+                return None
+            group_tries.append((names, trie_data))
+        return (plan_data, alphabet, group_tries)
+
+    def _artifact_digests(self, dict_chain, config_bytes):
+        """
+        Digests of the artifacts of a conversion. The digest of a group covers
+        its dictionary files and the digest of the conversion covers the
+        config file and the digests of the groups, so that every dictionary
+        file is read and hashed once.
+        :param dict_chain: the dict chain of dictionary file names, with the
+                           segmentation dictionaries
+        :param config_bytes: the contents of the config file
+        :return: tuple of the digest of the conversion artifact and the dict
+                 of the digests of the group artifacts by the tuple of their
+                 dictionary file names
+        """
+        group_digests = {}
+        for item in dict_chain:
+            names = tuple(self._flatten_chain(item))
+            if names not in group_digests:
+                group_digests[names] = self._compiled_digest(list(names), b'', COMPILED_FILE)
+        return (CompiledCache.digest(COMPILED_FILE, config_bytes, *group_digests.values()), group_digests)
+
+    def _read_artifact(self, name, digest):
+        """
+        :param name: the conversion name or the tuple of the dictionary file
+                     names of a group
+        :param digest: digest of the current sources of the artifact
+        :return: the data of the artifact, None if there is none or it was
+                 built from other sources
+        """
+        try:
+            artifact = self.resource_getter(COMPILED_FILE, artifact_name(name))
+        except ValueError:
+            # The resource getter has no compiled conversions
+            return None
+        if artifact is None:
+            return None
+        return load_artifact(artifact, digest)
+
+    def build_artifacts(self):
+        """
+        Compile the conversion ahead of time, to be shipped with the plugin.
+        Converters using any engine load it through the resource getter instead
+        of reading the dictionary files, as long as the config file and the
+        dictionaries are unchanged. Overlays are not included.
+
+        Each dictionary group of the conversion chain, and the segmentation
+        dictionaries, have their own artifact, named by artifact_name(tuple of
+        the dictionary file names), holding the trie of the group, so that
+        conversions using the same group share it. The artifact of the conversion, artifact_name(conversion name),
+        only holds the groups it uses, the layout of the plan and the alphabet.
+        :return: dict of the artifact file names to their bytes
+        """
+        if self.engine != ENGINE_TRIE:
+            raise ValueError('artifacts are built with ENGINE_TRIE')
+        state = self._init_dict()
+        config_bytes = self.resource_getter(CONFIG_FILE, self.conversion + '.json')
+        chain = state.dict_chain
+        if state.segmentation is not None:
+            chain = chain + [state.segmentation]
+        digest, group_digests = self._artifact_digests(chain, config_bytes)
+        artifacts = {}
+        groups = []
+        positions = {}
+        for item, trie in zip(state.dict_chain, plan_tries(state.trie_chain_data)):
+            names = tuple(self._flatten_chain(item))
+            positions[id(trie)] = len(groups)
+            groups.append(names)
+            artifacts[artifact_name(names)] = dump_artifact(group_digests[names], trie.to_data())
+        if state.segmentation is not None:
+            names = tuple(self._flatten_chain(state.segmentation))
+            if names not in groups:
+                # Segmentation dictionaries, compiled on their own by ENGINE_MMSEG
+                groups.append(names)
+                artifacts[artifact_name(names)] = dump_artifact(group_digests[names], self._get_trie(names).to_data())
+        plan_data = plan_to_data(state.trie_chain_data, lambda trie: positions[id(trie)])
+        artifacts[artifact_name(self.conversion)] = dump_artifact(digest, (groups, plan_data, "".join(state.alphabet)))
+        return artifacts
+
+    def _compiled_digest(self, dict_chain, config_bytes, kind=None):
+        """
+        Digest identifying the compiled form of a conversion in
+        self.compiled_cache or in an artifact. It changes with the engine, the
+        config file and the contents of every dictionary file the config uses.
+        :param dict_chain: the dict chain of dictionary file names
+        :param config_bytes: the contents of the config file
+        :param kind: used in place of the engine, COMPILED_FILE for artifacts
+        :return: hex digest
+        """
+        parts = [kind if kind is not None else self.engine, config_bytes]
+        for name in self._flatten_chain(dict_chain):
+            bytes = self.resource_getter(DICT_FILE, name)
+            if bytes is None:
+                raise IOError('unable to open opencc dictionary')
+            parts += [name, bytes]
+        return CompiledCache.digest(*parts)
 
     def _add_dictionaries(self, chain_list, chain_data):
+        """
+        Add the dictionaries of a dict chain, with the same nesting
+        :param chain_list: the dict chain of dictionary file names
+        :param chain_data: list to be filled with the dictionaries
+        :return: None
+        """
         for item in chain_list:
             if isinstance(item, list):
                 chain = []
                 self._add_dictionaries(item, chain)
                 chain_data.append(chain)
             else:
-                if not item in self.dict_cache:
-                    map_dict = {}
-                    max_len = 1
-                    bytes = self.resource_getter(DICT_FILE, item)
-                    if bytes is not None:
-                        converted_data = bytes.decode("utf-8")
-                        converted_data_list = converted_data.splitlines()
-                        for line in converted_data_list:
-                            #Skip blank lines and comments
-                            if (len(line) == 0) or (line[0] == '#'):
-                                continue
-                            key, value = line.strip().split('\t')
-                            map_dict[key] = value
-                            if len(key) > max_len:
-                                max_len = len(key)
-                        chain_data.append((max_len, map_dict))
-                        self.dict_cache[item] = (max_len, map_dict)
-                    else:
-                        #Raise exception
-                        raise IOError('unable to open opencc dictionary')
-                else:
-                    #Use the cached version
-                    chain_data.append(self.dict_cache[item])
+                chain_data.append(self._get_dictionary(item))
+
+    def _get_dictionary(self, item):
+        """
+        Get a dictionary from self.registry, reading it if it is not there
+        :param item: the dictionary file name
+        :return: tuple of the max key length and the dictionary
+        """
+        return self.registry.get((DICT_FILE, self.resource_getter, item), lambda: self._read_dictionary(item))
+
+    def _read_dictionary(self, item):
+        """
+        :param item: the dictionary file name
+        :return: tuple of the dictionary and its estimated size in bytes
+        """
+        bytes = self.resource_getter(DICT_FILE, item)
+        if bytes is None:
+            #Raise exception
+            raise IOError('unable to open opencc dictionary')
+        test_dict = self._parse_dictionary(bytes.decode("utf-8"))
+        return (test_dict, dict_size(test_dict[1]))
+
+    def _parse_dictionary(self, text):
+        """
+        :param text: the contents of a dictionary file, one tab separated key
+                     and value per line
+        :return: tuple of the max key length and the dictionary
+        """
+        map_dict = {}
+        max_len = 1
+        for line in text.splitlines():
+            #Skip blank lines and comments
+            if (len(line) == 0) or (line[0] == '#'):
+                continue
+            key, value = line.strip().split('\t')
+            # multiple mapping, use the first one
+            map_dict[key] = value.split(' ')[0]
+            if len(key) > max_len:
+                max_len = len(key)
+        return (max_len, map_dict)
+
+    def _chain_alphabet(self, chain_data):
+        """
+        Collect every character used in a key of the dictionaries in chain_data
+        :param chain_data: the dictionaries of a dict chain
+        :return: frozenset of characters
+        """
+        alphabet = set()
+        for max_len, map_dict in self._flatten_chain(chain_data):
+            alphabet.update("".join(map_dict))
+        # Share the character strings with the tries
+        return frozenset(map(sys.intern, alphabet))
+
+    def _plan_alphabet(self, plan):
+        """
+        :param plan: conversion plan from engine.compile_chain
+        :return: frozenset of the first characters of the keys of every trie
+                 of the plan
+        """
+        # A frozenset copied from a set has the smallest table
+        return frozenset(set().union(*[trie.key_starts for trie in plan_tries(plan)]))
+
+    def _add_tries(self, chain_list, chain_data, groups={}):
+        """
+        Compile a prefix trie for every dictionary or group of dictionaries in
+        chain_list. A group is compiled into a single trie. Tries are kept in
+        self.registry by the tuple of dictionary file names.
+        :param chain_list: the dict chain of dictionary file names
+        :param chain_data: list to be filled with the tries in chain order
+        :param groups: dict of the trie data of artifacts by the tuple of
+                       dictionary file names
+        :return: None
+        """
+        for item in chain_list:
+            names = tuple(self._flatten_chain(item))
+            chain_data.append(self._get_trie(names, groups.get(names)))
+
+    def _get_trie(self, names, trie_data=None):
+        """
+        Get the trie of a dictionary group from self.registry, compiling it if
+        it is not there
+        :param names: tuple of dictionary file names in group order
+        :param trie_data: the data of the trie from an artifact, None to
+                          compile it from the dictionaries
+        :return: DictTrie
+        """
+        return self.registry.get(('trie', self.resource_getter, names), lambda: self._compile_trie(names, trie_data))
+
+    def _compile_trie(self, names, trie_data=None):
+        """
+        The dictionaries are parsed for the trie only and not kept
+        :param names: tuple of dictionary file names in group order
+        :param trie_data: the data of the trie from an artifact or None
+        :return: tuple of the DictTrie and its estimated size in bytes
+        """
+        if trie_data is not None:
+            trie = DictTrie.from_data(trie_data)
+        else:
+            trie = DictTrie([self._read_dictionary(name)[0] for name in names])
+        return (trie, trie.estimated_size())
+
+    def _flatten_chain(self, item):
+        """
+        List the dictionaries of a dict chain item in group order
+        :param item: a dictionary (file name or data) or a list of them
+        :return: list of dictionaries
+        """
+        if not isinstance(item, list):
+            return [item]
+        names = []
+        for sub_item in item:
+            names += self._flatten_chain(sub_item)
+        return names
 
     def _add_dict_chain(self, dict_chain, dict_dict):
         """
@@ -198,20 +1017,89 @@ class OpenCC:
          check the json file names in config directory
         :return: None
         """
-        if self.conversion == conversion:
-            return
-        elif conversion == "no_conversion":
-            # just loopback the input
-            self.conversion = conversion
-        else:
-            self._dict_init_done = False
+        with self._state_lock:
+            if self.conversion == conversion:
+                return
             self.conversion = conversion
+            self._state = None
+            if self.segment_cache is not None:
+                self.segment_cache.clear()
+
+    def set_overlay(self, name, dictionary, entries):
+        """
+        Add, replace or remove a user dictionary taking precedence over one of
+        the dictionaries of the conversion chain. The overlay joins the stage
+        of that dictionary as a group, just before it, so its keys win where
+        both match. Changing an overlay compiles only the overlays, the
+        dictionaries and tries of the chain are not read or compiled again.
+        :param name: name of the overlay, used to replace or remove it and in
+                     the statistics
+        :param dictionary: file name of a dictionary of the conversion chain,
+                           such as 'STPhrases.txt'. Conversions without it do
+                           not use the overlay.
+        :param entries: dict of the keys and values, or text in the format of
+                        the dictionary files, None to remove the overlay
+        :return: None
+        """
+        test_dict = None
+        if isinstance(entries, str):
+            test_dict = self._parse_dictionary(entries)
+        elif entries is not None:
+            # multiple mapping, use the first one
+            map_dict = {key: value.split(' ')[0] for key, value in entries.items()}
+            test_dict = (max([1] + [len(key) for key in map_dict]), map_dict)
+        with self._state_lock:
+            if self.engine == ENGINE_MAPPED:
+                raise ValueError('ENGINE_MAPPED does not support overlays')
+            if test_dict is None:
+                self.overlays.pop(name, None)
+            else:
+                self.overlays[name] = (dictionary, test_dict)
+            self._state = None
+            if self.segment_cache is not None:
+                self.segment_cache.clear()
+
+    def enable_stats(self, enabled=True):
+        """
+        Start recording statistics in a new ConversionStats (self.stats), or
+        stop recording them. Only ENGINE_TRIE and ENGINE_MAPPED conversions are
+        recorded. Recording slows conversion down, converters not recording
+        are not affected.
+        :param enabled: False to stop recording
+        :return: None
+        """
+        self.stats = ConversionStats() if enabled else None
+
+    def get_stats(self):
+        """
+        :return: dict of the recorded statistics (see ConversionStats.as_dict),
+                 None if they are not recorded
+        """
+        stats = self.stats
+        return stats.as_dict() if stats is not None else None
+
+    def set_engine(self, engine):
+        """
+        set the conversion engine
+        :param engine: ENGINE_TRIE, ENGINE_TREE, ENGINE_MAPPED or ENGINE_MMSEG
+        :return: None
+        """
+        if engine not in (ENGINE_TRIE, ENGINE_TREE, ENGINE_MAPPED, ENGINE_MMSEG):
+            raise ValueError('unknown conversion engine')
+        with self._state_lock:
+            if engine == ENGINE_MAPPED and self.overlays:
+                raise ValueError('ENGINE_MAPPED does not support overlays')
+            if self.engine != engine:
+                self.engine = engine
+                self._state = None
 
 
 class StringTree:
     """
     Class to hold string during modification process.
     """
+    __slots__ = ('string', 'left', 'right', 'string_len', 'matched')
+
     def __init__(self, string):
         self.string = string
         self.left = None
@@ -229,51 +1117,51 @@ class StringTree:
                           applied against the string
         :return: None
         """
-        if self.matched == True:
+        if self.matched:
             if self.left is not None:
                 self.left.convert_tree(test_dict)
             if self.right is not None:
                 self.right.convert_tree(test_dict)
         else:
-            test_len = min(self.string_len, test_dict[0])
+            max_len, map_dict = test_dict
+            string = self.string
+            string_len = self.string_len
+            test_len = min(string_len, max_len)
             while test_len != 0:
                 # Loop through trying successively smaller substrings in the dictionary
-                for i in range(0, self.string_len - test_len + 1):
-                    if self.string[i:i+test_len] in test_dict[1]:
+                for i in range(0, string_len - test_len + 1):
+                    if string[i:i+test_len] in map_dict:
                         # Match found.
                         if i > 0:
                             # Put everything to the left of the match into the left sub-tree and further process it
-                            self.left = StringTree(self.string[:i])
+                            self.left = StringTree(string[:i])
                             self.left.convert_tree(test_dict)
-                        if (i+test_len) < self.string_len:
+                        if (i+test_len) < string_len:
                             # Put everything to the right of the match into the right sub-tree and further process it
-                            self.right = StringTree(self.string[i+test_len:])
+                            self.right = StringTree(string[i+test_len:])
                             self.right.convert_tree(test_dict)
                         # Save the dictionary value in this tree
-                        value = test_dict[1][self.string[i:i+test_len]]
-                        if len(value.split(' ')) > 1:
-                            # multiple mapping, use the first one for now
-                            value = value.split(' ')[0]
+                        value = map_dict[string[i:i+test_len]]
                         self.string = value
-                        self.string_len = len(self.string)
+                        self.string_len = len(value)
                         self.matched = True
                         return
                 test_len -= 1
 
     def inorder(self):
         """
-        Inorder traversal of this tree
+        Inorder traversal of this tree, without recursion
         :param None
         :return: list of words from a inorder traversal of the tree
         """
         result = []
-
-        if self.left is not None:
-            result += self.left.inorder()
-
-        result.append(self.string)
-
-        if self.right is not None:
-            result += self.right.inorder()
+        pending = []
+        node = self
+        while node is not None or pending:
+            while node is not None:
+                pending.append(node)
+                node = node.left
+            node = pending.pop()
+            result.append(node.string)
+            node = node.right
         return result
-
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+##########################################################
+# Author: Hopkins
+# Apache License Version 2.0, January 2004
+# - Resource getter reading the config file of a conversion, then every
+#   dictionary and compiled file (artifact) it needs, in one bulk load each
+#   instead of one load per file
+# - Files are kept once read, so the dictionaries read again for the digests
+#   of the compiled cache are not loaded again. clear() drops them once the
+#   conversion is compiled.
+# - Loads from the calibre plugin zip or from a directory
+##########################################################
+
+import json
+import os
+import threading
+
+from .diskcache import artifact_name
+from .opencc import COMPILED_FILE, CONFIG_FILE, DICT_FILE
+
+
+class PreloadedResources:
+    """
+    Resource getter of OpenCC loading files in bulk with load_many, a function
+    taking a list of file paths and returning a dict of the paths found to
+    their bytes, such as calibre's get_resources. Asking for the config file
+    of a conversion loads the config file, then the dictionaries and the
+    artifacts of the conversion and of its dictionary groups, in two calls to
+    load_many. Other files are
+    loaded alone the first time they are asked for.
+    """
+    __slots__ = ('load_many', 'prefixes', 'loads', '_files', '_lock')
+
+    def __init__(self, load_many, prefixes):
+        """
+        :param load_many: function taking a list of paths and returning a dict
+                          of the paths found to bytes
+        :param prefixes: dict of the file types served (CONFIG_FILE, DICT_FILE,
+                         COMPILED_FILE) to the path prefix of their files
+        """
+        self.load_many = load_many
+        self.prefixes = prefixes
+        # Number of calls to load_many
+        self.loads = 0
+        # Bytes or None for a missing file by (file type, file name)
+        self._files = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_directory(cls, directory, file_types=(CONFIG_FILE, DICT_FILE, COMPILED_FILE)):
+        """
+        Create a getter reading the files of each file type from the sub
+        directory of directory with the same name, as laid out in
+        resources/opencc_python
+        :param directory: the directory path
+        :param file_types: the file types served
+        :return: PreloadedResources
+        """
+        return cls(read_files, {file_type: os.path.join(directory, file_type, '') for file_type in file_types})
+
+    def __call__(self, file_type, file_name):
+        """
+        :param file_type: CONFIG_FILE, DICT_FILE or COMPILED_FILE
+        :param file_name: name of the file in the directory of its type
+        :return: bytes of the file, None if it does not exist
+        """
+        if file_type not in self.prefixes:
+            raise ValueError('conversion value incorrect')
+        key = (file_type, file_name)
+        with self._lock:
+            if key not in self._files:
+                self._load([key])
+                if file_type == CONFIG_FILE:
+                    self._load(self._config_files(file_name))
+            return self._files[key]
+
+    def preload(self, conversions):
+        """
+        Load the config files of conversions, then every file they use
+        :param conversions: list of conversion names such as 's2t'
+        :return: None
+        """
+        with self._lock:
+            configs = [(CONFIG_FILE, conversion + '.json') for conversion in conversions]
+            self._load(configs)
+            keys = []
+            for _, config in configs:
+                keys += self._config_files(config)
+            self._load(keys)
+
+    def clear(self):
+        """
+        Forget the files read. Call it once the conversions using them are
+        compiled (see OpenCC.prepare), the converters do not read them again.
+        :return: None
+        """
+        with self._lock:
+            self._files.clear()
+
+    def _config_files(self, config):
+        """
+        :param config: the file name of a config file, already read
+        :return: list of the keys of the files its conversion uses
+        """
+        config_bytes = self._files[(CONFIG_FILE, config)]
+        if config_bytes is None:
+            return []
+        setting_json = json.loads(config_bytes.decode("utf-8"))
+        keys = [(DICT_FILE, name) for name in config_dictionaries(setting_json)]
+        # The artifact of the segmentation group is only built when it is not a
+        # group of the chain, a missing file is not read again
+        names = [os.path.splitext(config)[0]] + config_groups(setting_json)
+        keys += [(COMPILED_FILE, artifact_name(name)) for name in names]
+        return keys
+
+    def _load(self, keys):
+        """
+        Load the files not yet read with one call to load_many
+        :param keys: list of (file type, file name)
+        :return: None
+        """
+        keys = [key for key in dict.fromkeys(keys) if key[0] in self.prefixes and key not in self._files]
+        if not keys:
+            return
+        paths = [self.prefixes[file_type] + file_name for file_type, file_name in keys]
+        self.loads += 1
+        found = self.load_many(paths)
+        for key, path in zip(keys, paths):
+            self._files[key] = found.get(path)
+
+
+def config_dictionaries(setting_json):
+    """
+    :param setting_json: the parsed config file
+    :return: list of the dictionary file names used by the conversion chain and
+             the segmentation of the config file
+    """
+    return [name for names in config_groups(setting_json) for name in names]
+
+
+def config_groups(setting_json):
+    """
+    :param setting_json: the parsed config file
+    :return: list of the tuples of the dictionary file names of each stage of
+             the conversion chain and of the segmentation of the config file
+    """
+    groups = []
+    dict_items = [chain.get('dict') for chain in setting_json.get('conversion_chain', [])]
+    segmentation_json = setting_json.get('segmentation')
+    if segmentation_json is not None:
+        dict_items.append(segmentation_json.get('dict'))
+    for dict_item in dict_items:
+        names = []
+        dict_dicts = [dict_item]
+        while dict_dicts:
+            dict_dict = dict_dicts.pop(0)
+            if dict_dict is None:
+                continue
+            if dict_dict.get('type') == 'group':
+                dict_dicts[:0] = dict_dict.get('dicts')
+            elif dict_dict.get('type') == 'txt':
+                names.append(dict_dict.get('file'))
+        if names:
+            groups.append(tuple(names))
+    return groups
+
+
+def read_files(paths):
+    """
+    load_many of PreloadedResources reading files from the file system
+    :param paths: list of file paths
+    :return: dict of the paths of the files that exist to their bytes
+    """
+    found = {}
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                found[path] = f.read()
+        except IOError:
+            pass
+    return found
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+##########################################################
+# Author: Hopkins
+# Apache License Version 2.0, January 2004
+# - Process wide registry of loaded dictionaries, compiled tries and compiled
+#   conversions shared by all OpenCC instances
+# - Least recently used entries are dropped when the estimated size of the
+#   registry goes over its memory budget. Entries used by another entry, such
+#   as the dictionaries of a compiled conversion, are only dropped with it.
+# - An entry is built without holding up the threads getting other entries
+##########################################################
+
+import sys
+import threading
+from collections import Counter, OrderedDict
+
+# Default memory budget of shared_registry in bytes
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+# Average size in bytes of the key and value strings of a dictionary entry,
+# measured on the OpenCC dictionaries
+ENTRY_SIZE = 160
+
+
+class Registry:
+    """
+    Thread safe store of objects built once and shared, each with an estimated
+    size in bytes. When the total size goes over the budget the least recently
+    used entries are dropped, keeping at least the newest one. A dropped entry
+    stays in memory while a converter still uses it and is built again when it
+    is next asked for.
+
+    The entries got while building an entry are its dependencies. They are
+    pinned while the entry is in the registry, since dropping them would free
+    nothing, so every object is counted once in the size. Each key is built
+    by one thread at a time; the registry lock is only held to look up and
+    update the entries.
+    """
+    __slots__ = ('budget', 'size', 'builds', 'evictions', '_entries', '_pins', '_build_locks', '_local', '_lock')
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        """
+        :param budget: the memory budget in bytes
+        """
+        self.budget = budget
+        self.size = 0
+        self.builds = 0
+        self.evictions = 0
+        # Lists of the object, its size and its dependencies by key
+        self._entries = OrderedDict()
+        # Number of entries and builds in progress using each key
+        self._pins = Counter()
+        # Lock of each key being built
+        self._build_locks = {}
+        # Sets of the keys got by the builds in progress of each thread
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """
+        Get an entry, building it if it is not in the registry
+        :param key: hashable key of the entry
+        :param build: function taking no parameters and returning a tuple of
+                      the object and its estimated size in bytes
+        :return: the object
+        """
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry[0]
+        with self._lock:
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        with build_lock:
+            # Another thread may have built it while this one waited
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry[0]
+            stack = self._building()
+            stack.append(set())
+            try:
+                obj, size = build()
+            except BaseException:
+                with self._lock:
+                    self._unpin(stack.pop())
+                    self._build_locks.pop(key, None)
+                raise
+            dependencies = stack.pop()
+            with self._lock:
+                self.builds += 1
+                self._entries[key] = [obj, size, dependencies]
+                self.size += size
+                self._build_locks.pop(key, None)
+                self._pin(key)
+                self._evict()
+            return obj
+
+    def _building(self):
+        """
+        :return: list of the dependency sets of the builds in progress in this
+                 thread, innermost last
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _lookup(self, key):
+        """
+        :param key: the key of the entry
+        :return: the entry or None. A found entry becomes a dependency of the
+                 build in progress in this thread.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._pin(key)
+            return entry
+
+    def _pin(self, key):
+        """
+        Make key a dependency of the build in progress in this thread, if any
+        """
+        stack = self._building()
+        if stack and key not in stack[-1]:
+            stack[-1].add(key)
+            self._pins[key] += 1
+
+    def _unpin(self, keys):
+        for key in keys:
+            if self._pins[key] > 1:
+                self._pins[key] -= 1
+            else:
+                del self._pins[key]
+
+    def set_budget(self, budget):
+        """
+        :param budget: the memory budget in bytes
+        :return: None
+        """
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    def clear(self):
+        """
+        Drop all entries. The counters are kept.
+        :return: None
+        """
+        with self._lock:
+            for entry in self._entries.values():
+                self._unpin(entry[2])
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        :return: dict of the entry count, estimated size, budget, builds and
+                 evictions
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'size': self.size, 'budget': self.budget,
+                    'builds': self.builds, 'evictions': self.evictions}
+
+    def _evict(self):
+        """
+        Drop the least recently used entries that no other entry uses until
+        the size is within the budget. The newest entry is kept.
+        :return: None
+        """
+        while self.size > self.budget and len(self._entries) > 1:
+            newest = next(reversed(self._entries))
+            key = next((key for key in self._entries if key != newest and self._pins[key] == 0), None)
+            if key is None:
+                return
+            entry = self._entries.pop(key)
+            self._unpin(entry[2])
+            self.size -= entry[1]
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def dict_size(map_dict):
+    """
+    :param map_dict: dictionary of strings
+    :return: estimated size in bytes of the dictionary, its keys and values.
+             The entries are not walked, so this takes no time.
+    """
+    return sys.getsizeof(map_dict) + len(map_dict) * ENTRY_SIZE
+
+
+# Registry used by OpenCC instances unless they are given their own
+shared_registry = Registry()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+##########################################################
+# Author: Hopkins
+# Apache License Version 2.0, January 2004
+# - Counters recorded by a converter with statistics enabled
+##########################################################
+
+import threading
+from collections import Counter
+
+# Names of the counters kept for each dictionary or group of dictionaries
+DICT_COUNTERS = ('lookups', 'probes', 'misses', 'replacements', 'translated', 'skipped')
+
+
+class ConversionStats:
+    """
+    Statistics of the conversions done by a converter:
+
+    mappings counts the replacements made by ("old", "new") pair.
+
+    dictionaries holds a Counter of DICT_COUNTERS for each dictionary, or group
+    of dictionaries joined with '+', of the conversion chain. A lookup is a walk
+    of the trie from one position of the text, a probe is one table lookup
+    during the walk and a miss is a lookup that found no key. replacements
+    counts the keys replaced. translated counts the strings converted with
+    str.translate, which makes no lookups. skipped counts the strings without
+    any character starting a key, which are passed on unchanged.
+
+    segment_lengths counts the segments converted by their length.
+
+    Every occurrence of a segment is counted, as if it had been converted on
+    its own, including the repeated segments of a batch and the segments
+    answered by the segment cache.
+    """
+    __slots__ = ('mappings', 'dictionaries', 'segment_lengths', '_lock')
+
+    def __init__(self):
+        self.mappings = Counter()
+        self.dictionaries = {}
+        self.segment_lengths = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, length, mappings, dictionaries, count=1):
+        """
+        Add the counts of a converted segment
+        :param length: the segment length
+        :param mappings: Counter by ("old", "new") pair
+        :param dictionaries: dict of Counters by dictionary name
+        :param count: number of occurrences of the segment
+        :return: None
+        """
+        with self._lock:
+            self.segment_lengths[length] += count
+            for mapping, number in mappings.items():
+                self.mappings[mapping] += number * count
+            for name, counts in dictionaries.items():
+                totals = self.dictionaries.setdefault(name, Counter())
+                for counter, number in counts.items():
+                    totals[counter] += number * count
+
+    def as_dict(self):
+        """
+        :return: dict of copies of mappings, dictionaries and segment_lengths
+        """
+        with self._lock:
+            return {'mappings': dict(self.mappings),
+                    'dictionaries': {name: dict(counts) for name, counts in self.dictionaries.items()},
+                    'segment_lengths': dict(self.segment_lengths)}
+
+    def report(self, top=20, cache_stats=None):
+        """
+        :param top: number of most frequent mappings to list
+        :param cache_stats: the stats() of the segment cache, None to leave
+                            them out
+        :return: the statistics as printable text
+        """
+        stats = self.as_dict()
+        lines = []
+        if cache_stats is not None:
+            lines.append('Segment cache: hits %d, misses %d, evictions %d, size %d of %d'
+                         % (cache_stats['hits'], cache_stats['misses'], cache_stats['evictions'],
+                            cache_stats['size'], cache_stats['maxsize']))
+        lines.append('Dictionaries:')
+        for name, counts in stats['dictionaries'].items():
+            lines.append('   ' + name + ': ' + ', '.join('%s %d' % (counter, counts.get(counter, 0))
+                                                         for counter in DICT_COUNTERS))
+        lines.append('Segments converted by length:')
+        for length, count in sorted(stats['segment_lengths'].items()):
+            lines.append('   %d: %d' % (length, count))
+        lines.append('Most frequent mappings:')
+        for (old, new), count in Counter(stats['mappings']).most_common(top):
+            lines.append('   %s -> %s: %d' % (old, new, count))
+        return '\n'.join(lines)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+##########################################################
+# Author: Hopkins
+# Apache License Version 2.0, January 2004
+# - Convert long strings with single character mappings through a dense code
+#   point lookup table with NumPy, when NumPy is installed
+# - Fall back to str.translate for short strings, for mappings to anything
+#   other than a single character and when NumPy is not installed
+# - NumPy is only imported when the first long string arrives
+##########################################################
+
+from .cache import LRUCache
+
+# The numpy module once imported, None if it is not installed
+numpy = None
+_numpy_imported = False
+
+# Minimum string length converted with a lookup table. Below it the cost of
+# encoding and decoding the string is more than str.translate takes.
+VECTOR_MIN_LENGTH = 8192
+
+# Marker cached for a translate table that cannot be made a lookup table
+_NO_LOOKUP = object()
+
+# Lookup tables by id of their translate table, each kept with the translate
+# table so that the id is not reused while it is cached
+_lookup_tables = LRUCache(64)
+
+
+def translate(string, table):
+    """
+    Same as string.translate(table) for a table mapping code points to strings
+    :param string: the input string
+    :param table: dict mapping code points to strings
+    :return: converted string
+    """
+    if len(string) < VECTOR_MIN_LENGTH or _import_numpy() is None:
+        return string.translate(table)
+    cached = _lookup_tables.get(id(table))
+    if cached is None or cached[0] is not table:
+        cached = (table, _lookup_table(table))
+        _lookup_tables.put(id(table), cached)
+    lookup = cached[1]
+    if lookup is _NO_LOOKUP:
+        return string.translate(table)
+    # Lone surrogates are kept as they are, like str.translate does
+    codes = numpy.frombuffer(string.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+    size = len(lookup)
+    converted = numpy.where(codes < size, lookup[numpy.minimum(codes, size - 1)], codes)
+    return converted.astype('<u4').tobytes().decode('utf-32-le', 'surrogatepass')
+
+
+def _import_numpy():
+    """
+    Import NumPy the first time it is needed
+    :return: the numpy module, None if it is not installed
+    """
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        _numpy_imported = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+def _lookup_table(table):
+    """
+    :param table: dict mapping code points to strings
+    :return: numpy array mapping every code point up to the highest key of
+             table, _NO_LOOKUP if a value is not a single character
+    """
+    if len(table) == 0 or any(len(value) != 1 for value in table.values()):
+        return _NO_LOOKUP
+    lookup = numpy.arange(max(table) + 1, dtype='<u4')
+    lookup[list(table)] = [ord(value) for value in table.values()]
+    return lookup
+
+
+def compose_tables(tables):
+    """
+    Combine translate tables applied one after the other into one table
+    :param tables: list of dicts mapping code points to strings
+    :return: dict mapping code points to strings
+    """
+    composed = {}
+    for table in tables:
+        composed = {code: value.translate(table) for code, value in composed.items()}
+        for code, value in table.items():
+            composed.setdefault(code, value)
+    return composed
@@ -1,7 +1,29 @@
+import asyncio
+import importlib.util
+import marshal
+import os
+import re
+import tempfile
+import threading
+import timeit
 import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-from ..main import get_resource_file
-from ..resources.opencc_python.opencc import OpenCC
+from lxml import etree
+
+from ..main import (get_resource_file, COMPILED_FILE, CONFIG_FILE, DICT_FILE, HTML_TextProcessor, LXML_TextProcessor,
+                    INPUT_SOURCE, CONVERSION_TYPE, QUOTATION_TYPE, OUTPUT_ORIENTATION, PUNC_DICT, PUNC_REGEX)
+from ..resources.opencc_python.opencc import (OpenCC, StringTree, ENGINE_TREE, ENGINE_TRIE, ENGINE_MAPPED, ENGINE_MMSEG,
+                                              SEPARATOR_RE)
+from ..resources.opencc_python.engine import (DictTrie, MergedStage, OverlaidTrie, SegmentedChain, plan_tries,
+                                              replace_spans, replace_tries)
+from ..resources.opencc_python.mapped import MappedTable
+from ..resources.opencc_python.preload import PreloadedResources, config_dictionaries
+from ..resources.opencc_python.registry import Registry
+from ..resources.opencc_python.async_opencc import AsyncOpenCC
+from ..resources.opencc_python import vectorized
 
 class TestOpenCC(unittest.TestCase):
 
@@ -140,6 +162,527 @@ class TestOpenCC(unittest.TestCase):
         words = '儘'
         self.assertEqual(self.openCC.convert(words), '尽')
 
+    def test_s2t_longest_match_first(self):
+        # 划不来 is longer than 㓦划 so it is used even though 㓦划 starts first
+        self.openCC.set_conversion('s2t')
+        words = '㓦划不来'
+        self.assertEqual(self.openCC.convert(words), '㓦划不來')
+
+    def test_engines_match(self):
+        words = '香烟（英语：Cigarette），为烟草制品的一种。內存是一种很常见及常用的电脑输入设备。㓦划不来'
+        tree = OpenCC(get_resource_file, 's2twp', ENGINE_TREE)
+        trie = OpenCC(get_resource_file, 's2twp', ENGINE_TRIE)
+        self.assertEqual(trie.convert(words), tree.convert(words))
+        trie.set_engine(ENGINE_TREE)
+        self.assertEqual(trie.convert(words), tree.convert(words))
+
+    def test_long_unpunctuated_run(self):
+        # Long runs are converted in windows without changing the result
+        words = '为烟草制品的一种㓦划不来香烟鼠标' * 1000
+        tree = OpenCC(get_resource_file, 's2t', ENGINE_TREE)
+        trie = OpenCC(get_resource_file, 's2t', ENGINE_TRIE)
+        converted = '爲菸草製品的一種㓦划不來香菸鼠標' * 1000
+        self.assertEqual(trie.convert(words), converted)
+        self.assertEqual(tree.convert(words), converted)
+        # Text without a boundary is matched with a trie of the group
+        test_dict = (6, {'甲乙': 'X', '乙甲': 'Y', '甲乙丙丁戊己': 'Z'})
+        words = '甲乙' * 5000
+        self.assertEqual(tree._split_long(words, [test_dict]), [words])
+        self.assertEqual(tree._convert(words, [test_dict]), 'X' * 5000)
+
+    def test_alphabet_prefilter(self):
+        self.openCC.set_conversion('t2jp')
+        self.assertEqual(self.openCC.convert('鄭重兩'), '鄭重両')
+        self.assertNotIn('C', self.openCC._get_state().alphabet)
+        # Segments without a dictionary key character never reach the engine
+        self.openCC._convert_trie = None
+        self.assertEqual(self.openCC.convert('Cigarette 123'), 'Cigarette 123')
+
+    def test_separator_runs(self):
+        self.assertEqual(SEPARATOR_RE.split('“香烟， 鼠标……”-x'), ['', '“', '香烟', '， ', '鼠标', '……”-', 'x'])
+        self.openCC.set_conversion('s2t')
+        self.assertEqual(self.openCC.convert('“香烟， 鼠标……”'), '“香菸， 鼠標……”')
+
+    def test_stage_prefilter(self):
+        # A stage whose keys cannot start in the text is passed over
+        trie = DictTrie([(2, {'AB': 'x', 'C': 'y'})])
+        self.assertEqual(trie.key_starts, frozenset('AC'))
+        words = 'BDB'
+        self.assertIs(trie.convert(words), words)
+        converter = OpenCC(get_resource_file, 's2tw', engine=ENGINE_TREE)
+        state = converter._get_state()
+        self.assertEqual(len(state.stage_alphabets), len(state.dict_chain_data))
+        words = '香烟（英语：Cigarette），为烟草制品的一种。鼠标'
+        self.assertEqual(converter.convert(words), OpenCC(get_resource_file, 's2tw').convert(words))
+
+    def test_segment_cache(self):
+        converter = OpenCC(get_resource_file, 's2t', cache_size=2)
+        words = '香烟，为烟草制品，鼠标'
+        self.assertEqual(converter.convert(words), '香菸，爲菸草製品，鼠標')
+        self.assertEqual(converter.convert('鼠标'), '鼠標')
+        self.assertEqual(converter.segment_cache.stats(),
+                         {'hits': 1, 'misses': 3, 'evictions': 1, 'size': 2, 'maxsize': 2})
+        # Changing the conversion drops the cached segments
+        converter.set_conversion('s2tw')
+        self.assertEqual(len(converter.segment_cache), 0)
+        self.assertEqual(converter.convert(words), '香菸，為菸草製品，鼠標')
+
+    def test_convert_many(self):
+        self.openCC.set_conversion('s2t')
+        words = ['香烟，为烟草制品', '', '鼠标', '香烟，为烟草制品', 'Cigarette']
+        converted = self.openCC.convert_many(words)
+        self.assertEqual(converted, ['香菸，爲菸草製品', '', '鼠標', '香菸，爲菸草製品', 'Cigarette'])
+        self.assertEqual(converted, [self.openCC.convert(word) for word in words])
+        self.assertEqual(self.openCC.convert_many(iter([])), [])
+
+    def test_convert_stream(self):
+        self.openCC.set_conversion('s2twp')
+        words = '香烟（英语：Cigarette），为烟草制品的一种。內存是一种很常见及常用的电脑输入设备。'
+        chunks = [words[i:i+3] for i in range(0, len(words), 3)]
+        self.assertEqual(''.join(self.openCC.convert_stream(chunks)), self.openCC.convert(words))
+        # A long run without separators is converted as it arrives
+        words = '为烟草制品的一种內存是一种很常见及常用的电脑输入设备' * 500
+        chunks = [words[i:i+1000] for i in range(0, len(words), 1000)]
+        converted = list(self.openCC.convert_stream(chunks))
+        self.assertGreater(len(converted), 1)
+        self.assertEqual(''.join(converted), self.openCC.convert(words))
+
+    def test_compiled_cache(self):
+        words = '香烟（英语：Cigarette），为烟草制品的一种。鼠标'
+        expected = OpenCC(get_resource_file, 's2twp').convert(words)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = OpenCC(get_resource_file, 's2twp', cache_dir=cache_dir)
+            self.assertEqual(first.convert(words), expected)
+            # A second converter loads everything from the cache
+            second = OpenCC(get_resource_file, cache_dir=cache_dir, registry=Registry())
+            second._add_tries = None
+            second.set_conversion('s2twp')
+            with mock.patch.object(OpenCC, '_parse_dictionary', side_effect=AssertionError):
+                self.assertEqual(second.convert(words), expected)
+            # A changed dictionary is parsed again
+            def changed_resource(file_type, file_name):
+                data = get_resource_file(file_type, file_name)
+                if file_name == 'STCharacters.txt':
+                    data += '鼠\t老\n'.encode('utf-8')
+                return data
+            third = OpenCC(changed_resource, 's2twp', cache_dir=cache_dir)
+            self.assertEqual(third.convert('鼠'), '老')
+
+    def test_compiled_load_time(self):
+        names = ['STPhrases.txt', 'STCharacters.txt']
+        texts = [get_resource_file(DICT_FILE, name).decode('utf-8') for name in names]
+        data = marshal.dumps(DictTrie([self.openCC._parse_dictionary(text) for text in texts]).to_data())
+        # Loading the compiled trie of a group beats parsing its dictionaries
+        parse_time = min(timeit.repeat(lambda: [self.openCC._parse_dictionary(text) for text in texts],
+                                       number=1, repeat=3))
+        load_time = min(timeit.repeat(lambda: DictTrie.from_data(marshal.loads(data)), number=1, repeat=3))
+        self.assertLess(load_time, parse_time)
+
+    def test_mapped_engine(self):
+        words = '香烟（英语：Cigarette），为烟草制品的一种。鼠标' * 3
+        expected = OpenCC(get_resource_file, 's2twp').convert(words)
+        self.assertRaises(ValueError, OpenCC, get_resource_file, 's2twp', ENGINE_MAPPED)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = OpenCC(get_resource_file, 's2twp', ENGINE_MAPPED, cache_dir=cache_dir)
+            self.assertEqual(first.convert(words), expected)
+            # A second converter maps the file without reading the dictionaries
+            second = OpenCC(get_resource_file, 's2twp', ENGINE_MAPPED, cache_dir=cache_dir,
+                            registry=Registry())
+            self.assertEqual(len(second.registry), 1)
+            self.assertIsInstance(second._state.trie_chain_data[0].stages[0].table, MappedTable)
+            self.assertEqual(second.convert(words), expected)
+            self.assertEqual("".join(second.convert_stream(words)), expected)
+
+    def test_registry(self):
+        registry = Registry()
+        first = OpenCC(get_resource_file, 's2tw', registry=registry)
+        second = OpenCC(get_resource_file, 's2tw', registry=registry)
+        # The second converter reuses the dictionaries and tries of the first
+        self.assertIs(second._state, first._state)
+        builds = registry.builds
+        second.set_conversion('s2t')
+        second.convert('鼠标')
+        self.assertEqual(registry.builds, builds + 1)
+        # Over the budget only the most recently used entry and the entries it
+        # uses are kept
+        entries = len(registry)
+        registry.set_budget(0)
+        self.assertGreater(registry.stats()['evictions'], 0)
+        self.assertLess(len(registry), entries)
+        self.assertGreater(len(registry), 1)
+        self.assertEqual(second.convert('鼠标'), '鼠標')
+        # Dropping the conversion unpins its dictionaries
+        registry.get('other', lambda: (None, 1))
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(registry.stats()['size'], 1)
+
+    def test_registry_build_lock(self):
+        # Building one entry does not hold up getting another
+        registry = Registry()
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_build():
+            started.set()
+            release.wait(5)
+            return ('slow', 1)
+
+        with ThreadPoolExecutor(2) as executor:
+            slow = executor.submit(registry.get, 'slow', slow_build)
+            started.wait(5)
+            self.assertEqual(registry.get('fast', lambda: ('fast', 1)), 'fast')
+            # A second thread asking for the key being built waits for it
+            waiting = executor.submit(registry.get, 'slow', lambda: ('again', 1))
+            release.set()
+            self.assertEqual(slow.result(), 'slow')
+            self.assertEqual(waiting.result(), 'slow')
+        self.assertEqual(registry.builds, 2)
+
+    def test_threads(self):
+        # Threads share one converter, which is compiled by the first call
+        words = ['香烟（英语：Cigarette），为烟草制品的一种。', '鼠标', '内存是一种很常见及常用的电脑输入设备', '']
+        expected = [OpenCC(get_resource_file, 's2twp').convert(word) for word in words] * 50
+        sequential = Registry()
+        OpenCC(get_resource_file, 's2twp', registry=sequential)
+        converter = OpenCC(get_resource_file, cache_size=8, registry=Registry())
+        converter.set_conversion('s2twp')
+        with ThreadPoolExecutor(8) as executor:
+            self.assertEqual(list(executor.map(converter.convert, words * 50)), expected)
+            self.assertEqual(list(executor.map(converter.convert_many, [words] * 50)), [expected[:4]] * 50)
+        self.assertEqual(converter.registry.builds, sequential.builds)
+
+    def test_async(self):
+        words = ['香烟%d，鼠标' % number for number in range(200)]
+        expected = self.openCC2.convert_many(words)
+
+        async def convert():
+            async with AsyncOpenCC(self.openCC2, batch_size=16, queue_size=8) as converter:
+                converted = await converter.convert_many(words)
+                # Requests made together share batches
+                self.assertLess(converter.batches, len(words))
+                self.assertEqual(await converter.convert(words[0]), expected[0])
+                return converted
+
+        self.assertEqual(asyncio.run(convert()), expected)
+
+    def test_prepare(self):
+        self.openCC.set_conversion('s2t')
+        self.assertEqual(self.openCC.conversion_name, '')
+        self.openCC.prepare()
+        self.assertNotEqual(self.openCC.conversion_name, '')
+
+    def test_stats(self):
+        converter = OpenCC(get_resource_file, 's2t')
+        self.assertIsNone(converter.get_stats())
+        converter.enable_stats()
+        self.assertEqual(converter.convert('香烟，鼠标鼠标'), '香菸，鼠標鼠標')
+        stats = converter.get_stats()
+        self.assertEqual(stats['mappings'], {('香烟', '香菸'): 1, ('标', '標'): 2})
+        self.assertEqual(stats['segment_lengths'], {2: 1, 4: 1})
+        counts = stats['dictionaries']['STPhrases.txt+STCharacters.txt']
+        self.assertEqual((counts['lookups'], counts['misses'], counts['replacements']), (6, 2, 3))
+        # No key of the second stage starts in the output of the first one
+        converter.set_conversion('s2tw')
+        converter.enable_stats()
+        self.assertEqual(converter.convert('鼠标'), '鼠標')
+        self.assertEqual(converter.get_stats()['dictionaries']['TWVariantsPhrases.txt+TWVariants.txt'], {'skipped': 1})
+        converter.enable_stats(False)
+        self.assertIsNone(converter.get_stats())
+
+    def test_stats_occurrences(self):
+        # Repeated strings and segments and the segments answered by the
+        # segment cache are counted every time they occur
+        for cache_size in (0, 16):
+            converter = OpenCC(get_resource_file, 's2t', cache_size=cache_size)
+            converter.enable_stats()
+            self.assertEqual(converter.convert_many(['鼠标', '鼠标', '鼠标，鼠标']), ['鼠標', '鼠標', '鼠標，鼠標'])
+            self.assertEqual(converter.convert('鼠标，abc'), '鼠標，abc')
+            stats = converter.get_stats()
+            self.assertEqual(stats['mappings'], {('标', '標'): 5})
+            self.assertEqual(stats['segment_lengths'], {2: 5, 3: 1})
+            counts = stats['dictionaries']['STPhrases.txt+STCharacters.txt']
+            self.assertEqual((counts['replacements'], counts['skipped']), (5, 1))
+        self.assertIn('Segment cache: hits 1, misses 2', converter.stats.report(cache_stats=converter.segment_cache.stats()))
+
+    def test_dict_trie_group(self):
+        # BCD is the longest key but AB is in the first dictionary of the group
+        group = [(2, {'AB': 'x'}), (3, {'BCD': 'y', 'D': 'z'})]
+        tree = StringTree('ABCD')
+        for test_dict in group:
+            tree.convert_tree(test_dict)
+        trie = DictTrie(group)
+        self.assertEqual(replace_spans('ABCD', trie.match('ABCD')), 'xCz')
+        self.assertEqual(tree.inorder(), ['x', 'C', 'z'])
+        # The values are packed in one string, with the dictionary of each key
+        self.assertEqual((trie.values, list(trie.offsets), trie.priorities), ('xyz', [0, 1, 2, 3], b'\x00\x01\x01'))
+        # Keys are numbered from the base of their first character
+        self.assertEqual((trie.table, trie.bases), ({'AB': 0, 'BCD': 0, 'D': 0}, {'A': 0, 'B': 1, 'D': 2}))
+        # Key prefixes are not stored, only the key lengths by first character
+        self.assertNotIn('BC', trie.table)
+        self.assertEqual(trie.key_lengths, {'A': (2,), 'B': (3,), 'D': (1,)})
+        self.assertEqual(trie.phrase_starts, frozenset('AB'))
+
+    def test_dict_trie_overlay(self):
+        group = [(2, {'AB': 'x', 'C': 'y'}), (3, {'BCD': 'y', 'D': 'z'})]
+        overlay = (4, {'BC': 'o', 'D': 'p', 'ABCD': 'q'})
+        for position in range(3):
+            expected = DictTrie(group[:position] + [overlay] + group[position:])
+            base = DictTrie(group)
+            trie = OverlaidTrie(base, [(position, overlay)])
+            # The base trie is shared, not compiled again
+            self.assertIs(trie.table, base.table)
+            self.assertEqual(dict(trie.items()), dict(expected.items()))
+            self.assertEqual(trie.character_table, expected.character_table)
+            self.assertEqual(trie.key_lengths, expected.key_lengths)
+            for string in ['ABCDCAB', 'DBCD', 'CABCD']:
+                self.assertEqual(trie.convert(string), expected.convert(string))
+                self.assertEqual(trie.segment(string), expected.segment(string))
+                self.assertEqual(trie.convert_segment(string), expected.convert_segment(string))
+                self.assertEqual(trie.safe_cut(string), expected.safe_cut(string))
+                self.assertEqual(trie.count_match(string, Counter()), expected.count_match(string, Counter()))
+
+    def test_merged_stage_overlay(self):
+        first = DictTrie([(2, {'AB': 'x', 'C': 'y'})])
+        second = DictTrie([(2, {'xy': 'z', 'y': 'w'})])
+        plan = [MergedStage(first, second)]
+        # A new key of the first trie whose value starts a phrase of the second
+        overlaid = replace_tries(plan, {0: OverlaidTrie(first, [(0, (1, {'D': 'x'}))])})
+        self.assertIsInstance(overlaid[0], MergedStage)
+        self.assertEqual(overlaid[0].guard, plan[0].guard | {'D'})
+        self.assertEqual(overlaid[0].convert('DC'), 'z')
+        # A new phrase start of the second trie needs a new guard
+        overlaid = replace_tries(plan, {1: OverlaidTrie(second, [(0, (2, {'yy': 'v'}))])})
+        self.assertEqual(len(overlaid), 2)
+        self.assertEqual(overlaid[1].convert(overlaid[0].convert('CC')), 'v')
+
+    def test_overlay(self):
+        for engine in [ENGINE_TRIE, ENGINE_TREE]:
+            converter = OpenCC(get_resource_file, 's2tw', engine=engine)
+            base_state = converter._get_state()
+            converter.set_overlay('house', 'STPhrases.txt', {'鼠标': '滑鼠'})
+            converter.set_overlay('chars', 'STCharacters.txt', '# comment\n烟\t煙 菸\n')
+            self.assertEqual(converter.convert('香烟，鼠标，烟'), '香菸，滑鼠，煙')
+            self.assertEqual(converter._get_state().dict_chain[0],
+                             ['house', 'STPhrases.txt', 'chars', 'STCharacters.txt'])
+            # Overlays on dictionaries the conversion does not use are ignored
+            converter.set_overlay('tw', 'TSPhrases.txt', {'鼠': 'x'})
+            self.assertEqual(converter.convert('鼠标'), '滑鼠')
+            for name in ['house', 'chars', 'tw']:
+                converter.set_overlay(name, None, None)
+            self.assertIs(converter._get_state(), base_state)
+        with self.assertRaises(ValueError):
+            converter.set_overlay('house', 'STPhrases.txt', {'鼠标': '滑鼠'})
+            converter.set_engine(ENGINE_MAPPED)
+
+    def test_segmented_chain(self):
+        segmenter = DictTrie([(2, {'AB': 'AB', 'BC': 'BC'})])
+        self.assertEqual(segmenter.segment('XABCY'), ['X', 'AB', 'CY'])
+        # The first dictionary of a group with a key at the position wins
+        trie = DictTrie([(1, {'A': 'x'}), (2, {'AB': 'y'})])
+        self.assertEqual(trie.convert_segment('AB'), 'xB')
+        # Keys cannot span segments, unlike the longest match anywhere
+        stage = DictTrie([(2, {'BC': 'q', 'C': 'c', 'A': 'a'})])
+        self.assertEqual(stage.convert('ABC'), 'aq')
+        self.assertEqual(SegmentedChain(segmenter, [stage]).convert('ABC'), 'aBc')
+        self.assertEqual(SegmentedChain(None, [stage]).convert('ABC'), 'aq')
+
+    def test_mmseg_engine(self):
+        converter = OpenCC(get_resource_file, 's2twp', engine=ENGINE_MMSEG)
+        self.assertEqual(converter._get_state().segmentation, 'STPhrases.txt')
+        words = '香烟（英语：Cigarette），为烟草制品的一种。鼠标是一种很常见及常用的电脑输入设备。'
+        self.assertEqual(converter.convert(words), OpenCC(get_resource_file, 's2twp').convert(words))
+        converter.set_overlay('house', 'STPhrases.txt', {'烟草制品': '菸草產品'})
+        self.assertEqual(converter.convert('为烟草制品'), '為菸草產品')
+
+    def test_artifact(self):
+        artifacts = {}
+
+        def resource_getter(file_type, file_name):
+            if file_type == COMPILED_FILE:
+                return artifacts.get(file_name)
+            return get_resource_file(file_type, file_name)
+
+        words = '香烟（英语：Cigarette），为烟草制品的一种。鼠标是一种很常见及常用的电脑输入设备。'
+        expected = OpenCC(get_resource_file, 's2twp').convert(words)
+        artifacts.update(OpenCC(resource_getter, 's2twp', registry=Registry()).build_artifacts())
+        # Each group, and the segmentation dictionaries, have their own artifact
+        self.assertEqual(sorted(artifacts), ['STPhrases.txt+STCharacters.txt.occ', 'STPhrases.txt.occ',
+                                             'TWPhrases.txt+TWVariantsPhrases.txt+TWVariants.txt.occ', 's2twp.occ'])
+        self.assertLess(len(artifacts['s2twp.occ']), len(artifacts['STPhrases.txt+STCharacters.txt.occ']) / 10)
+        # The dictionaries are not read with the trie engines
+        with mock.patch.object(OpenCC, '_parse_dictionary', side_effect=AssertionError):
+            for engine in [ENGINE_TRIE, ENGINE_MMSEG]:
+                converter = OpenCC(resource_getter, 's2twp', engine=engine, registry=Registry())
+                self.assertEqual(converter.convert(words), expected)
+            # ENGINE_MAPPED writes its mapped file from the artifact
+            with tempfile.TemporaryDirectory() as cache_dir:
+                converter = OpenCC(resource_getter, 's2twp', ENGINE_MAPPED, cache_dir=cache_dir, registry=Registry())
+                self.assertEqual(converter.convert(words), expected)
+        # Loading the artifacts beats parsing the dictionaries, as ENGINE_TREE does
+        def load_time(getter, engine):
+            return min(timeit.repeat(lambda: OpenCC(getter, 's2twp', engine=engine, registry=Registry())._get_state(),
+                                     number=1, repeat=3))
+        self.assertLess(load_time(resource_getter, ENGINE_TRIE), load_time(get_resource_file, ENGINE_TREE))
+        # Conversions using the same group share its trie
+        registry = Registry()
+        converter = OpenCC(resource_getter, 's2twp', registry=registry)
+        self.assertEqual(converter.convert(words), expected)
+        artifacts.update(OpenCC(resource_getter, 's2t', registry=Registry()).build_artifacts())
+        self.assertIs(OpenCC(resource_getter, 's2t', registry=registry)._get_state().trie_chain_data[0],
+                      plan_tries(converter._get_state().trie_chain_data)[0])
+        # An artifact of other sources is ignored
+        artifacts['s2twp.occ'] = OpenCC(resource_getter, 's2tw', registry=Registry()).build_artifacts()['s2tw.occ']
+        self.assertEqual(OpenCC(resource_getter, 's2twp', registry=Registry()).convert(words), expected)
+        artifacts.pop('STPhrases.txt+STCharacters.txt.occ')
+        self.assertEqual(OpenCC(resource_getter, 's2t', registry=Registry()).convert(words),
+                         OpenCC(get_resource_file, 's2t').convert(words))
+        artifacts['s2twp.occ'] = b'not an artifact'
+        self.assertEqual(OpenCC(resource_getter, 's2twp', registry=Registry()).convert(words), expected)
+
+    def test_preload(self):
+        directory = os.path.join(os.path.dirname(__file__), '..', 'resources', 'opencc_python')
+        resource_getter = PreloadedResources.from_directory(directory)
+        words = '香烟（英语：Cigarette），为烟草制品的一种。鼠标是一种很常见及常用的电脑输入设备。'
+        converter = OpenCC(resource_getter, 's2twp', registry=Registry())
+        self.assertEqual(converter.convert(words), OpenCC(get_resource_file, 's2twp').convert(words))
+        # The config file, then its dictionaries and compiled conversion
+        self.assertEqual(resource_getter.loads, 2)
+        self.assertEqual(resource_getter(DICT_FILE, 'STPhrases.txt'), get_resource_file(DICT_FILE, 'STPhrases.txt'))
+        self.assertEqual(resource_getter.loads, 2)
+        self.assertIsNone(resource_getter(DICT_FILE, 'missing.txt'))
+        self.assertEqual(resource_getter.loads, 3)
+        resource_getter.preload(['t2s', 'tw2sp'])
+        self.assertEqual(resource_getter.loads, 5)
+        OpenCC(resource_getter, 'tw2sp', registry=Registry())
+        self.assertEqual(resource_getter.loads, 5)
+        # Compiled converters do not need the files any more
+        resource_getter.clear()
+        self.assertEqual(converter.convert(words), OpenCC(get_resource_file, 's2twp').convert(words))
+        self.assertEqual(resource_getter.loads, 5)
+        with self.assertRaises(ValueError):
+            PreloadedResources.from_directory(directory, (CONFIG_FILE, DICT_FILE))(COMPILED_FILE, 's2t.occ')
+        self.assertEqual(config_dictionaries({'segmentation': {'type': 'mmseg', 'dict': {'type': 'txt', 'file': 'C'}},
+                                              'conversion_chain': [{'dict': {'type': 'group', 'dicts': [
+                                                  {'type': 'txt', 'file': 'A'}, {'type': 'txt', 'file': 'B'}]}}]}),
+                         ['A', 'B', 'C'])
+
+    def test_merged_stage(self):
+        first = DictTrie([(2, {'AB': 'xy', 'D': 'x'})])
+        second = DictTrie([(2, {'yC': 'Q'}), (1, {'x': 'X', 'C': 'c'})])
+        merged = MergedStage(first, second)
+        for words in ['ABC', 'DC', 'CAD', 'ABDC', '']:
+            self.assertEqual(merged.convert(words), second.convert(first.convert(words)))
+        # No phrase of the second stage can appear so it is a translate
+        self.assertTrue(merged.guard.isdisjoint('DC'))
+        self.assertFalse(merged.guard.isdisjoint('AB'))
+        self.assertEqual(merged.convert('DC'), 'Xc')
+
+    def test_translate_fast_path(self):
+        # Only single character keys can match so str.translate is used
+        trie = DictTrie([(2, {'AB': 'x'}), (1, {'A': 'y z', 'C': 'w'})])
+        self.assertEqual(trie.phrase_starts, frozenset('A'))
+        self.assertEqual(trie.character_table, {ord('A'): 'y', ord('C'): 'w'})
+        self.assertEqual(trie.convert('CBC'), 'wBw')
+        self.assertEqual(trie.convert('ACAB'), 'ywx')
+
+    def test_text_table(self):
+        # Every stage of t2jp maps single characters, separators are left out
+        converter = OpenCC(get_resource_file, 't2jp')
+        self.assertIsNotNone(converter._get_state().text_table)
+        self.assertIsNone(OpenCC(get_resource_file, 's2t')._get_state().text_table)
+        words = '鄭重兩辨御亞，' * 2000
+        self.assertEqual(converter.convert(words), '鄭重両弁御亜，' * 2000)
+        converter.enable_stats()
+        self.assertEqual(converter.convert(words), '鄭重両弁御亜，' * 2000)
+
+    @unittest.skipIf(importlib.util.find_spec('numpy') is None, 'NumPy is not installed')
+    def test_vectorized_translate(self):
+        table = {ord('A'): 'y', ord('C'): '𠀀'}
+        words = 'ACB𠀁' * vectorized.VECTOR_MIN_LENGTH
+        self.assertEqual(vectorized.translate(words, table), words.translate(table))
+        # Values of more than one character fall back to str.translate
+        table = {ord('A'): 'y z'}
+        self.assertEqual(vectorized.translate(words, table), words.translate(table))
+        # Lone surrogates are not encoded
+        words = '兩\ud800，' * vectorized.VECTOR_MIN_LENGTH
+        self.assertEqual(vectorized.translate(words, {ord('兩'): '両'}), words.translate({ord('兩'): '両'}))
+        self.assertEqual(OpenCC(get_resource_file, 't2jp').convert(words), words.replace('兩', '両'))
+        self.assertEqual(vectorized.compose_tables([{ord('A'): 'B'}, {ord('B'): 'C', ord('D'): 'E'}]),
+                         {ord('A'): 'C', ord('B'): 'C', ord('D'): 'E'})
+
+class TestTextProcessor(unittest.TestCase):
+
+    # Book file using every feature the processors handle
+    XHTML = ('<?xml version="1.0" encoding="utf-8"?>\n'
+             '<html xmlns="http://www.w3.org/1999/xhtml" lang="zh-CN" xml:lang="zh-CN"><head><title>鼠标</title></head>\n'
+             '<body%s>\n<p lang="zh">香烟，“鼠标”。 &amp; 测试</p><p lang="zh-Hans"></p>'
+             '<!-- PI_SELTEXT_START -->\n<p>「软件」<span xml:lang="zh-Hans">内存</span>尾巴，<br/>后面</p>'
+             '<!--PI_SELTEXT_END--><p lang="zh-Latn">汉字</p><img lang="zh" src="a.png"/>结束？</body></html>')
+
+    def setUp(self):
+        converter = OpenCC(get_resource_file, 's2twp')
+        self.html_processor = HTML_TextProcessor(converter)
+        self.lxml_processor = LXML_TextProcessor(converter)
+        self.html_processor.setLanguageAttribute('lang="zh-Hant"')
+        self.lxml_processor.setLanguageCode('zh-Hant')
+
+    def criteria(self, input_source, conversion_type=2, quotation_type=0, output_orientation=0):
+        criteria = [0, 0, 0, 2, False, 0, 0, False, None, None]
+        criteria[INPUT_SOURCE] = input_source
+        criteria[CONVERSION_TYPE] = conversion_type
+        criteria[QUOTATION_TYPE] = quotation_type
+        criteria[OUTPUT_ORIENTATION] = output_orientation
+        return criteria
+
+    def process(self, document, criteria):
+        """
+        :return: tuple of the trees converted by HTML_TextProcessor and
+                 LXML_TextProcessor and whether LXML_TextProcessor changed one
+        """
+        html_root = etree.fromstring(self.html_processor.processText(document, criteria).encode('utf-8'))
+        lxml_root = etree.fromstring(document.encode('utf-8'))
+        changed = self.lxml_processor.processTree(lxml_root, criteria)
+        return (etree.tostring(html_root, encoding='unicode'), etree.tostring(lxml_root, encoding='unicode'), changed)
+
+    def test_processors_match(self):
+        # Both processors give the same tree for the whole book, the current
+        # file and the selected text
+        for body in ['', ' class="chapter"', ' class="calibre-chinese_text"']:
+            document = self.XHTML % body
+            original = etree.tostring(etree.fromstring(document.encode('utf-8')), encoding='unicode')
+            for input_source in [0, 1, 2]:
+                for quotation_type in [0, 1, 2]:
+                    for output_orientation in [0, 1, 2]:
+                        criteria = self.criteria(input_source, quotation_type=quotation_type,
+                                                 output_orientation=output_orientation)
+                        if output_orientation == 2:
+                            criteria[PUNC_DICT] = {'，': '︐', '。': '︒', '「': '﹁', '」': '﹂'}
+                            criteria[PUNC_REGEX] = re.compile('|'.join(map(re.escape, criteria[PUNC_DICT])))
+                        html_tree, lxml_tree, changed = self.process(document, criteria)
+                        self.assertEqual(lxml_tree, html_tree)
+                        self.assertEqual(changed, html_tree != original)
+
+    def test_selected_text(self):
+        criteria = self.criteria(2, quotation_type=2)
+        _, lxml_tree, _ = self.process(self.XHTML % '', criteria)
+        # Only the text and tags between the comments are converted
+        self.assertIn('<p lang="zh">香烟，“鼠标”。 &amp; 测试</p>', lxml_tree)
+        self.assertIn('<p>「軟體」<span xml:lang="zh-Hant">記憶體</span>尾巴，<br/>後面</p>', lxml_tree)
+        self.assertIn('<img lang="zh" src="a.png"/>结束？', lxml_tree)
+
+    def test_lang_attributes(self):
+        for input_source in [0, 1]:
+            _, lxml_tree, _ = self.process(self.XHTML % '', self.criteria(input_source))
+            self.assertIn('lang="zh-Hant" xml:lang="zh-Hant"', lxml_tree)
+            # An element without content is not a self-closing tag
+            self.assertIn('<p lang="zh-Hant"/>', lxml_tree)
+            self.assertIn('<p lang="zh-Latn">', lxml_tree)
+            # Self-closing tags are only updated when converting the whole book
+            self.assertIn('<img lang="%s"' % ('zh-Hant' if input_source == 0 else 'zh'), lxml_tree)
+        # Nothing changes without a conversion, quotes or orientation
+        self.assertEqual(self.process(self.XHTML % '', self.criteria(0, conversion_type=0))[2], False)
+
+
 if __name__ == '__main__':
     sys.path.append(os.pardir)
     from opencc import OpenCC